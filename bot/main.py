@@ -1,10 +1,13 @@
 """Bot configuration"""
 import asyncio
 import logging
+import signal
 
 from aiogram import Dispatcher, Bot
 from aiogram.client.default import DefaultBotProperties
 from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 from fluent_compiler.bundle import FluentBundle
 from fluentogram import FluentTranslator, TranslatorHub
 
@@ -13,10 +16,18 @@ from shared.utils.middlewares import (
     ThrottlingMiddleware,
     DataBaseMiddleware,
     UserMiddleware,
-    TranslateMiddleware, AlbumMiddleware, MessageCleanupMiddleware)
+    TranslateMiddleware, AlbumMiddleware, MessageCleanupMiddleware, TraceMiddleware)
 
+from shared.utils.assets import asset_registry
+from shared.utils.category_tree import category_tree
+from shared.utils.code_index import code_index
 from shared.utils.config import settings
 from shared.utils.db import db
+from shared.utils.fsm_storage import MongoStateStorage
+from shared.utils.indexes import bootstrap_indexes, index_report
+from shared.utils.metrics import metrics_handler
+from shared.utils.tracing import TelegramMetricsMiddleware
+from shared.utils.user_cache import user_cache
 
 
 
@@ -43,19 +54,87 @@ t_hub = TranslatorHub(
 )
 
 
+async def health(_request: web.Request) -> web.Response:
+    """
+    Liveness probe for the load balancer
+    :param _request:
+    :return: ok
+    """
+    return web.Response(text="ok")
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot):
+    """
+    Serve updates over the webhook until SIGTERM/SIGINT.
+    Updates are handled inside the request, so the graceful shutdown
+    of aiohttp lets in-flight updates finish
+    :param dp:
+    :param bot:
+    :return: None
+    """
+    app = web.Application()
+    handler = SimpleRequestHandler(dispatcher=dp,
+                                   bot=bot,
+                                   handle_in_background=False,
+                                   secret_token=settings.WEBHOOK_SECRET)
+    handler.register(app, path=settings.WEBHOOK_PATH)
+    app.router.add_get("/health", health)
+    app.router.add_get("/metrics", metrics_handler)
+    setup_application(app, dp, bot=bot)
+
+    await bot.set_webhook(url=f"{settings.WEBHOOK_URL}{settings.WEBHOOK_PATH}",
+                          secret_token=settings.WEBHOOK_SECRET,
+                          allowed_updates=dp.resolve_used_update_types())
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, settings.WEBHOOK_HOST, settings.WEBHOOK_PORT)
+    await site.start()
+    logger.info("Webhook server started on %s:%s%s",
+                settings.WEBHOOK_HOST, settings.WEBHOOK_PORT, settings.WEBHOOK_PATH)
+    try:
+        await stop.wait()
+    finally:
+        logger.info("Webhook server stopping")
+        await runner.cleanup()
+
+
+async def start_metrics_server() -> web.AppRunner:
+    """
+    /metrics and /health in polling mode (webhook mode serves them itself)
+    :return: runner to clean up on shutdown
+    """
+    app = web.Application()
+    app.router.add_get("/health", health)
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, settings.WEBHOOK_HOST, settings.METRICS_PORT).start()
+    logger.info("Metrics server started on %s:%s", settings.WEBHOOK_HOST, settings.METRICS_PORT)
+    return runner
+
+
 async def main():
     """
     Bot, middlewares, session configuration
     :return: None
     """
     session = AiohttpSession()
+    session.middleware(TelegramMetricsMiddleware())
     bot = Bot(
         token=settings.BOT_TOKEN,
         session=session,
         default=DefaultBotProperties(parse_mode="HTML")
     )
 
-    dp = Dispatcher(t_hub=t_hub)
+    dp = Dispatcher(storage=MongoStateStorage(db.fsm, cache_ttl=settings.FSM_CACHE_TTL),
+                    t_hub=t_hub)
+    dp.update.outer_middleware(TraceMiddleware())
     dp.message.middleware(ThrottlingMiddleware())
     dp.message.outer_middleware(DataBaseMiddleware(db=db))
     dp.message.outer_middleware(UserMiddleware())
@@ -73,13 +152,32 @@ async def main():
 
     dp.include_router(main_router)
 
+    await bootstrap_indexes(db)
+    await index_report(db)
+    await category_tree.load()
+    await code_index.load()
+    await asset_registry.warm_up(bot, settings.CACHE_CHAT_ID, "src/assets")
+    category_watcher = asyncio.create_task(category_tree.watch())
+    user_watcher = asyncio.create_task(user_cache.watch(db.users))
+    code_watcher = asyncio.create_task(code_index.watch())
+
     try:
-        await dp.start_polling(bot)
+        if settings.BOT_MODE == "webhook":
+            await run_webhook(dp, bot)
+        else:
+            metrics_runner = await start_metrics_server()
+            try:
+                await dp.start_polling(bot)
+            finally:
+                await metrics_runner.cleanup()
     except ValueError as e:
         logger.error("ValueError occurred: %s", e)
     except KeyError as e:
         logger.error("KeyError occurred: %s", e)
     finally:
+        category_watcher.cancel()
+        user_watcher.cancel()
+        code_watcher.cancel()
         await bot.session.close()
 
 
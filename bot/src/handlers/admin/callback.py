@@ -3,12 +3,15 @@ import time
 import uuid
 
 from aiogram import Router, Bot
-from aiogram.exceptions import TelegramAPIError
 from aiogram.fsm.context import FSMContext
-from aiogram.types import CallbackQuery, InputMediaPhoto, FSInputFile, InlineKeyboardButton
+from aiogram.types import CallbackQuery, InputMediaPhoto, InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from fluentogram import TranslatorRunner
 
+from shared.utils.assets import asset_registry
+from shared.utils.broadcast import create_broadcast
+from shared.utils.category_tree import category_tree
+from shared.utils.code_index import code_index
 from shared.utils.functions import send_category_content
 from shared.utils.functions_admin import keyboard_back
 
@@ -48,13 +51,16 @@ async def _(callback_query: CallbackQuery,
             locale: TranslatorRunner):
     await callback_query.answer(locale.category.delete())
     await db.category.delete_one({"id": callback_data.current_id})
+    category_tree.discard(callback_data.current_id)
     keyboard = await keyboard_back(callback_data.parent_id, locale)
-    await bot.edit_message_media(chat_id=callback_query.from_user.id,
-                                 message_id=callback_query.message.message_id,
-                                 media=InputMediaPhoto(
-                                     media=FSInputFile("src/assets/no_image.png"),
-                                     caption=locale.category.deleted()),
-                                 reply_markup=keyboard)
+    res = await bot.edit_message_media(chat_id=callback_query.from_user.id,
+                                       message_id=callback_query.message.message_id,
+                                       media=InputMediaPhoto(
+                                           media=await asset_registry.photo(
+                                               "src/assets/no_image.png"),
+                                           caption=locale.category.deleted()),
+                                       reply_markup=keyboard)
+    await asset_registry.remember("src/assets/no_image.png", res)
 
 
 @router.callback_query(CategoryRename.filter())
@@ -176,7 +182,9 @@ async def _(callback_query: CallbackQuery,
                                       "updated_at": time.time()})
     else:
         await db.category.update_one({"id": callback_data.current_id},
-                                     {callback_data.type: []})
+                                     {callback_data.type: [],
+                                      "updated_at": time.time()})
+    await category_tree.compile(callback_data.current_id)
     await callback_query.answer(text="Удаление прошло успешно", show_alert=True)
     await keyboard_back(callback_data.parent_id, locale)
     await send_category_content(
@@ -230,14 +238,13 @@ async def mailing_start(callback_query: CallbackQuery,
 
 @router.callback_query(SendMailing.filter())
 async def send_all_confirm(callback_query: CallbackQuery,
-                           db: MongoDbClient,
                            callback_data: SendMailing,
                            locale: TranslatorRunner,
                            bot: Bot):
     """
-    Mailing send
+    Mailing send.
+    The broadcast is queued for the worker, which edits the wait message with progress
     :param callback_query:
-    :param db:
     :param callback_data:
     :param locale:
     :param bot:
@@ -247,35 +254,12 @@ async def send_all_confirm(callback_query: CallbackQuery,
     await bot.delete_message(
         chat_id=callback_query.from_user.id,
         message_id=callback_query.message.message_id)
-    users = await db.users.find({}, count=10000000)
-    users_list = [{'id': user.id} for user in users]
-    successful_sends = 0
-    failed_sends = 0
     mes = await bot.send_message(
         chat_id=callback_query.from_user.id,
         text=locale.mailing.wait())
-    for user in users_list:
-        try:
-            await bot.copy_message(
-                chat_id=int(user['id']),
-                from_chat_id=callback_query.from_user.id,
-                message_id=int(callback_data.mes_id))
-            successful_sends += 1
-        except TelegramAPIError:
-            failed_sends += 1
-    keyboard = InlineKeyboardBuilder()
-    keyboard.row(InlineKeyboardButton(
-        text=locale.backbutton(),
-        callback_data=Start().pack()))
-    await bot.delete_message(
-        chat_id=callback_query.from_user.id,
-        message_id=mes.message_id)
-    await bot.send_message(
-        chat_id=callback_query.from_user.id,
-        text=locale.mailing.sent(total_users=len(users_list),
-                                 successful_sends=successful_sends,
-                                 failed_sends=failed_sends),
-        reply_markup=keyboard.as_markup())
+    await create_broadcast(admin_id=callback_query.from_user.id,
+                           message_id=int(callback_data.mes_id),
+                           progress_message_id=mes.message_id)
 
 
 @router.callback_query(SubscriptionSettings.filter())
@@ -355,6 +339,7 @@ async def _(callback_query: CallbackQuery,
             await db.promo_codes.insert_one({"promo_code": promo_code,
                                              "period": callback_data.period,
                                              "usages": callback_data.usages})
+            await code_index.refresh_promo_code(promo_code)
             text = f"Промокод успешно создан: \n<code>{promo_code}</code>"
         else:
             keyboard.row(
@@ -461,6 +446,7 @@ async def _(callback_query: CallbackQuery,
                 {"to_period": callback_data.to_period,
                  "period": callback_data.period,
                  "created_at": time.time()}, upsert=True)
+            await code_index.refresh_discount(callback_data.discount.lower())
             await state.set_state(DiscountCreateState.discount_price)
             await bot.edit_message_caption(
                 chat_id=callback_query.from_user.id,
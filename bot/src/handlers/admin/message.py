@@ -1,4 +1,5 @@
 """Admin message router connect"""
+import logging
 import time
 from asyncio import gather
 
@@ -14,6 +15,8 @@ from shared.models.category import ContentItem
 from shared.utils.callbacks import (SendMailing, Start, ChangePrice,
                                     Cabinet, PromoCreate, DiscountsCallback, \
     DiscountsFinish, SubscriptionSettings)
+from shared.utils.category_tree import category_tree
+from shared.utils.code_index import code_index
 from shared.utils.config import settings
 from shared.utils.functions_admin import keyboard_back
 
@@ -21,6 +24,7 @@ from shared.utils.db import MongoDbClient
 from shared.utils.fsm_state import (CategoryName, CategoryMedia, MailingAll,
                                     ChangePriceState, DiscountCreateState)
 from shared.utils.functions import generate_unique_category_id, send_category_content
+from shared.utils.subscription import deactivation
 
 router = Router()
 
@@ -42,6 +46,7 @@ async def _(message: Message,
             "parent_id": parent_id if parent_id else None,
             "name": message.text,
             "created_at": time.time()})
+        await category_tree.refresh(category_id)
         await bot.delete_message(chat_id=message.from_user.id,
                                  message_id=message.message_id)
         await bot.edit_message_text(
@@ -63,7 +68,9 @@ async def _(message: Message,
     parent_id = data.get("parent_id")
     current_id = data.get("current_id")
     await db.category.update_one({"id": current_id},
-                                 {"name": message.text})
+                                 {"name": message.text,
+                                  "updated_at": time.time()})
+    await category_tree.refresh(current_id)
     keyboard = await keyboard_back(parent_id, locale)
     await bot.delete_message(chat_id=message.from_user.id,
                              message_id=message.message_id)
@@ -101,12 +108,14 @@ async def _(message: Message,
                 message_id=message.message_id
             )
     except TelegramBadRequest as e:
-        print(f"Ошибка при удалении сообщений: {e}")
+        logging.warning("Ошибка при удалении сообщений: %s", e)
     if message.text:
         await db.category.update_one(
             {"id": current_id},
-            {"caption": message.html_text},
+            {"caption": message.html_text,
+             "updated_at": time.time()},
             upsert=True)
+        await category_tree.refresh(current_id)
         try:
             await bot.delete_message(chat_id=message.from_user.id,
                                      message_id=int(data.get("message_id")))
@@ -156,8 +165,10 @@ async def _(message: Message,
                     content_data = [{"type": "media_group", "file_id": [*existing_files, file_id]}]
                 await db.category.update_one(
                     {"id": current_id},
-                    {"documents": content_data}
+                    {"documents": content_data,
+                     "updated_at": time.time()}
                 )
+                await category_tree.compile(current_id)
                 # pylint: disable=duplicate-code
                 await send_category_content(
                     bot=bot,
@@ -188,9 +199,11 @@ async def _(message: Message,
 
     await db.category.update_one(
         {"id": current_id},
-        {file_type: content_data},
+        {file_type: content_data,
+         "updated_at": time.time()},
         upsert=True
     )
+    await category_tree.compile(current_id)
     # pylint: disable=duplicate-code
     await send_category_content(
         bot=bot,
@@ -244,7 +257,6 @@ async def _(message: Message,
     period = data.get('period')
     try:
         float_number = float(message.text)
-        print(f"float_number: {float_number}")
         await db.config_admin.update_one({"id": 1},
                                          {period: float_number})
         config = await db.config_admin.find_one({"id": 1})
@@ -342,6 +354,7 @@ async def _(message: Message,
         await db.discounts.update_one({"promo_code": discount},
                                       {"price": price,
                                        "created_at": time.time()})
+        await code_index.refresh_discount(discount.lower())
         await bot.edit_message_caption(
             chat_id=message.from_user.id,
             message_id=message_id,
@@ -369,10 +382,7 @@ async def _(message: Message,
         try:
             user_id = int(command_parts[1])
             try:
-                await db.users.update_one({"id": user_id},
-                                          {"subscribed": False,
-                                           "subscribed_date": None,
-                                           "subscribed_period": None})
+                await db.users.update_one({"id": user_id}, deactivation())
             except:
                 pass
             await message.answer(f"Подписка деактивирована для пользователя с ID: {user_id}")
@@ -1,22 +1,27 @@
 """User callback handlers """
 import decimal
 import time
+from datetime import datetime, timedelta, timezone
 
 from aiogram import types, Bot, Router
 from aiogram.fsm.context import FSMContext
-from aiogram.types import FSInputFile, InlineKeyboardButton
+from aiogram.types import InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from fluentogram import TranslatorRunner
 
+from shared.models.transactions import TRANSACTION_TTL, next_check_at
+from shared.models.user import User
+from shared.utils.assets import asset_registry
 from shared.utils.callbacks import (Knowledge,
                                     Cabinet, SubscriptionPeriod,
                                     SubscriptionInvoice, Start,
                                     Category, SubscriptionSettings, PromoActivate, Contacts, Info)
+from shared.utils.category_tree import category_tree
 from shared.utils.fsm_state import PromoActivateState
-from shared.utils.functions import (calculate_subscription_info,
-                                    generate_unique_order_id, build_menu_keyboard,
+from shared.utils.functions import (generate_unique_order_id, build_menu_keyboard,
                                     send_category_content, subscription_offer)
 from shared.utils.robokassa import PaymentData, generate_payment_link, RobokassaConfig
+from shared.utils.subscription import calculate_subscription_info, stored_end
 
 from shared.utils.config import settings
 from shared.utils.db import MongoDbClient
@@ -37,11 +42,10 @@ async def _(callback_query: types.CallbackQuery,
     )
     await bot.delete_message(chat_id=callback_query.from_user.id,
                              message_id=callback_query.message.message_id)
-    await bot.send_photo(chat_id=callback_query.from_user.id,
-                         photo=FSInputFile("src/assets/welcome.jpg",
-                                           filename="welcome.jpg"),
-                         caption=locale.text.welcome(),
-                         reply_markup=keyboard_menu)
+    await asset_registry.send_photo(bot, callback_query.from_user.id,
+                                    "src/assets/welcome.jpg",
+                                    caption=locale.text.welcome(),
+                                    reply_markup=keyboard_menu)
     await state.clear()
 
 
@@ -50,7 +54,7 @@ async def _(callback_query: types.CallbackQuery,
             bot: Bot,
             db: MongoDbClient,
             locale: TranslatorRunner):
-    category = await db.category.find({"id": "Contacts"})
+    category = category_tree.get("Contacts")
     if category:
         # pylint: disable=duplicate-code
         await send_category_content(
@@ -60,7 +64,8 @@ async def _(callback_query: types.CallbackQuery,
             locale=locale
         )
     else:
-        await db.category.insert_one({"id": "Contacts"})
+        await db.category.insert_one({"id": "Contacts", "created_at": time.time()})
+        await category_tree.refresh("Contacts")
         # pylint: disable=duplicate-code
         await send_category_content(
             bot=bot,
@@ -75,7 +80,7 @@ async def _(callback_query: types.CallbackQuery,
             bot: Bot,
             db: MongoDbClient,
             locale: TranslatorRunner):
-    category = await db.category.find({"id": "Info"})
+    category = category_tree.get("Info")
     if category:
         # pylint: disable=duplicate-code
         await send_category_content(
@@ -85,7 +90,8 @@ async def _(callback_query: types.CallbackQuery,
             locale=locale
         )
     else:
-        await db.category.insert_one({"id": "Info"})
+        await db.category.insert_one({"id": "Info", "created_at": time.time()})
+        await category_tree.refresh("Info")
         # pylint: disable=duplicate-code
         await send_category_content(
             bot=bot,
@@ -100,12 +106,12 @@ async def _(callback_query: types.CallbackQuery,
 async def _(callback_query: types.CallbackQuery,
             bot: Bot,
             db: MongoDbClient,
+            user: User,
             locale: TranslatorRunner):
     await callback_query.answer(locale.menubutton1())
-    user = await db.users.find_one({"id": callback_query.from_user.id})
     if user.subscribed:
 
-        category = await db.category.find({"id": "Knowledge"})
+        category = category_tree.get("Knowledge")
         if category:
             # pylint: disable=duplicate-code
             await send_category_content(
@@ -115,7 +121,8 @@ async def _(callback_query: types.CallbackQuery,
                 locale=locale
             )
         else:
-            await db.category.insert_one({"id": "Knowledge"})
+            await db.category.insert_one({"id": "Knowledge", "created_at": time.time()})
+            await category_tree.refresh("Knowledge")
             # pylint: disable=duplicate-code
             await send_category_content(
                 bot=bot,
@@ -146,16 +153,12 @@ async def _(callback_query: types.CallbackQuery,
 @router.callback_query(Cabinet.filter())
 async def _(callback_query: types.CallbackQuery,
             bot: Bot,
-            db: MongoDbClient,
+            user: User,
             locale: TranslatorRunner):
     await callback_query.answer(locale.menubutton2())
-    res = await db.users.find_one({"id": callback_query.from_user.id})
     keyboard_info = InlineKeyboardBuilder()
-    if res.subscribed:
-        remaining_days, end_time = calculate_subscription_info(
-            subscribed_date=res.subscribed_date,
-            subscribed_period=res.subscribed_period
-        )
+    if user.subscribed:
+        remaining_days, end_time = calculate_subscription_info(stored_end(user))
         caption = locale.subscription.subscribed(remaining_days=remaining_days,
                                                  end_time=end_time)
     else:
@@ -186,6 +189,7 @@ async def _(callback_query: types.CallbackQuery,
 async def _(callback_query: types.CallbackQuery,
             bot: Bot,
             locale: TranslatorRunner,
+            user: User,
             db: MongoDbClient):
     await callback_query.answer(locale.buybutton())
     keyboard_period = InlineKeyboardBuilder()
@@ -197,21 +201,20 @@ async def _(callback_query: types.CallbackQuery,
                                           "half_year": 1.00,
                                           "year": 1.00})
         config = await db.config_admin.find_one({"id": 1})
-    personal_discounts = await db.users.find_one({"id": callback_query.from_user.id})
-    if personal_discounts.personal_month:
-        price_month = personal_discounts.personal_month
+    if user.personal_month:
+        price_month = user.personal_month
     else:
         price_month = config.one_month
-    if personal_discounts.personal_three_month:
-        price_three_month = personal_discounts.personal_three_month
+    if user.personal_three_month:
+        price_three_month = user.personal_three_month
     else:
         price_three_month = config.three_month
-    if personal_discounts.personal_half_year:
-        price_half_year = personal_discounts.personal_half_year
+    if user.personal_half_year:
+        price_half_year = user.personal_half_year
     else:
         price_half_year = config.half_year
-    if personal_discounts.personal_year:
-        price_year = personal_discounts.personal_year
+    if user.personal_year:
+        price_year = user.personal_year
     else:
         price_year = config.year
     periods = [
@@ -220,7 +223,6 @@ async def _(callback_query: types.CallbackQuery,
         (6, locale.halfyear(), price_half_year),
         (12, locale.year(), price_year)
     ]
-    print(f"periods: {periods}")
     for period, text, price in periods:
         keyboard_period.row(
             InlineKeyboardButton(
@@ -292,12 +294,15 @@ async def _(callback_query: types.CallbackQuery,
         caption=locale.subscription.pay(period_subscription=callback_data.period,
                                         price_subscription=callback_data.price),
         reply_markup=keyboard_link.as_markup())
+    created_at = time.time()
     await db.transactions.insert_one({
         "order_id": order_id,
         "user_id": callback_query.from_user.id,
         "period": int(callback_data.period),
         "message_id": callback_query.message.message_id,
-        "created_at": time.time()
+        "created_at": created_at,
+        "next_check_at": next_check_at(created_at, created_at),
+        "expire_at": datetime.now(tz=timezone.utc) + timedelta(seconds=TRANSACTION_TTL)
     })
 
 
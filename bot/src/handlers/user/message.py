@@ -4,15 +4,18 @@ import time
 from aiogram import types, Bot, Router
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
-from aiogram.types import FSInputFile, InlineKeyboardButton
+from aiogram.types import InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from fluentogram import TranslatorRunner
 
+from shared.utils.assets import asset_registry
 from shared.utils.callbacks import Cabinet
+from shared.utils.code_index import code_index
 from shared.utils.db import MongoDbClient
 from shared.utils.fsm_state import PromoActivateState
 from shared.utils.functions import build_menu_keyboard
 from shared.utils.config import settings
+from shared.utils.promo import redeem_promo_code
 
 router = Router()
 
@@ -25,11 +28,10 @@ async def _(message: types.Message, bot: Bot, locale: TranslatorRunner):
         admin_ids=settings.ADMIN_IDS,
     )
 
-    await bot.send_photo(chat_id=message.from_user.id,
-                         photo=FSInputFile(
-                             "src/assets/welcome.jpg", filename="welcome.jpg"),
-                         caption=locale.text.welcome(),
-                         reply_markup=keyboard_menu)
+    await asset_registry.send_photo(bot, message.from_user.id,
+                                    "src/assets/welcome.jpg",
+                                    caption=locale.text.welcome(),
+                                    reply_markup=keyboard_menu)
 
 
 @router.message(PromoActivateState.promo_enter)
@@ -42,18 +44,13 @@ async def _(message: types.Message,
     keyboard = InlineKeyboardBuilder()
     data = await state.get_data()
     message_id = data.get("message_id")
-    promo_code = await db.promo_codes.find_one({"promo_code": message.text})
-    if promo_code:
-        if promo_code.usages >= 1:
-            await db.users.update_one({"id": message.from_user.id},
-                                      {"subscribed_date": time.time(),
-                                       "subscribed": True,
-                                       "subscribed_period": promo_code.period})
+    redeemed = None
+    if await code_index.is_promo_code(message.text):
+        redeemed = await redeem_promo_code(db, message.from_user.id, message.text)
+    if redeemed:
+        if redeemed == "activated":
             caption = "Промокод успешно активирован!"
-            await db.promo_codes.update_one({"promo_code": message.text},
-                                            {"usages": int(promo_code.usages - 1)})
         else:
-            await db.promo_codes.delete_one({"promo_code": message.text})
             caption = "Извините, этот промокод истек"
         keyboard.row(InlineKeyboardButton(text="Назад", callback_data=Cabinet().pack()))
         await bot.edit_message_caption(
@@ -63,7 +60,7 @@ async def _(message: types.Message,
             reply_markup=keyboard.as_markup()
         )
     else:
-        discount = await db.discounts.find_one({"promo_code": message.text.lower()})
+        discount = await code_index.discount(message.text.lower())
         if discount:
             time_passed_seconds = time.time() - discount.created_at
             time_passed_days = time_passed_seconds / (24 * 60 * 60)
@@ -0,0 +1,13 @@
+mailing-progress = ⏳ Рассылка идет...
+    Обработано: { $total }
+    Доставлено: { $sent }
+    Заблокировали бота: { $blocked }
+    Ошибок: { $failed }
+
+mailing-done = ✅ Рассылка завершена
+    Обработано: { $total }
+    Доставлено: { $sent }
+    Заблокировали бота: { $blocked }
+    Ошибок: { $failed }
+
+mailing-back = Назад
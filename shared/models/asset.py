@@ -0,0 +1,19 @@
+"""Static asset uploaded to Telegram"""
+from typing import ClassVar, List, Optional
+
+from pydantic import BaseModel
+from pymongo import ASCENDING, IndexModel
+
+
+class Asset(BaseModel):
+    """
+    Asset model
+    """
+    indexes: ClassVar[List[IndexModel]] = [
+        IndexModel([("sha256", ASCENDING)], unique=True),
+    ]
+
+    sha256: str
+    file_id: str
+    name: Optional[str] = None
+    created_at: float = 0.0
@@ -0,0 +1,30 @@
+"""Broadcast (mailing) job model"""
+from typing import ClassVar, List, Optional
+
+from pydantic import BaseModel
+from pymongo import ASCENDING, IndexModel
+
+
+class Broadcast(BaseModel):
+    """
+    Broadcast model.
+    cursor is the last user id handled, users are walked in id order
+    """
+    indexes: ClassVar[List[IndexModel]] = [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("status", ASCENDING)]),
+    ]
+
+    id: str
+    admin_id: int
+    from_chat_id: int
+    message_id: int
+    progress_message_id: Optional[int] = None
+    status: str = "running"
+    cursor: Optional[int] = None
+    total: int = 0
+    sent: int = 0
+    failed: int = 0
+    blocked: int = 0
+    created_at: float = 0.0
+    updated_at: float = 0.0
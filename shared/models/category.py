@@ -1,6 +1,7 @@
 """Category database model"""
-from typing import List, Optional
+from typing import ClassVar, List, Optional
 from pydantic import BaseModel, Field
+from pymongo import ASCENDING, IndexModel
 
 
 class ContentItem(BaseModel):
@@ -10,10 +11,27 @@ class ContentItem(BaseModel):
     type: Optional[str] = None
     file_id: List[str] = Field(default_factory=list)
 
+
+class RenderStep(BaseModel):
+    """
+    One send of the compiled render plan:
+    method - Bot method (send_media_group, send_photo, ..., send_voice),
+    media - InputMedia type of a media group (photo, video, audio, document)
+    """
+    method: str
+    media: Optional[str] = None
+    file_ids: List[str] = Field(default_factory=list)
+
+
 class CategoryModel(BaseModel):
     """
     Category model
     """
+    indexes: ClassVar[List[IndexModel]] = [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("parent_id", ASCENDING)]),
+    ]
+
     id: Optional[str] = None
     name: Optional[str] = "Название"
     type: Optional[str] = None
@@ -26,5 +44,6 @@ class CategoryModel(BaseModel):
     messages: List[ContentItem] = Field(default_factory=list)
     parent_id: Optional[str] = None
     caption: Optional[str] = None
+    render_plan: Optional[List[RenderStep]] = None
     created_at: float = 0.0
     updated_at: float = 0.0
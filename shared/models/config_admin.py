@@ -1,13 +1,18 @@
 """Admin config in bot"""
-from typing import Optional
+from typing import ClassVar, List, Optional
 
 from pydantic import BaseModel
+from pymongo import ASCENDING, IndexModel
 
 
 class ConfigAdmin(BaseModel):
     """
     ConfigAdmin model
     """
+    indexes: ClassVar[List[IndexModel]] = [
+        IndexModel([("id", ASCENDING)], unique=True),
+    ]
+
     id: int = 1
     one_month: Optional[float] = 1.00
     three_month: Optional[float] = 1.00
@@ -1,13 +1,18 @@
 """Discounts model"""
-from typing import Optional
+from typing import ClassVar, List, Optional
 
 from pydantic import BaseModel
+from pymongo import ASCENDING, IndexModel
 
 
 class Discounts(BaseModel):
     """
     PromoCodes model
     """
+    indexes: ClassVar[List[IndexModel]] = [
+        IndexModel([("promo_code", ASCENDING)], unique=True),
+    ]
+
     promo_code: str
     created_at: Optional[float] = 0.0
     discount_amount: Optional[int] = 0
@@ -0,0 +1,22 @@
+"""FSM record model (aiogram state and data of a chat)"""
+from datetime import datetime
+from typing import ClassVar, List, Optional
+
+from pydantic import BaseModel, Field
+from pymongo import ASCENDING, IndexModel
+
+# abandoned states (unfinished uploads, promo entry) are removed after a day
+FSM_TTL = 24 * 60 * 60
+
+
+class FsmRecord(BaseModel):
+    """
+    FSM record, _id is the storage key
+    """
+    indexes: ClassVar[List[IndexModel]] = [
+        IndexModel([("updated_at", ASCENDING)], expireAfterSeconds=FSM_TTL),
+    ]
+
+    state: Optional[str] = None
+    data: dict = Field(default_factory=dict)
+    updated_at: Optional[datetime] = None
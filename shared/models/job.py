@@ -0,0 +1,27 @@
+"""Background job model (queue in the jobs collection)"""
+from typing import ClassVar, List, Optional
+
+from pydantic import BaseModel, Field
+from pymongo import ASCENDING, IndexModel
+
+
+class Job(BaseModel):
+    """
+    Job model.
+    status: queued -> running -> done | failed
+    """
+    indexes: ClassVar[List[IndexModel]] = [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("status", ASCENDING), ("lease_until", ASCENDING)]),
+    ]
+
+    id: str
+    type: str
+    payload: dict = Field(default_factory=dict)
+    status: str = "queued"
+    worker_id: Optional[str] = None
+    lease_until: float = 0.0
+    attempts: int = 0
+    error: Optional[str] = None
+    created_at: float = 0.0
+    updated_at: float = 0.0
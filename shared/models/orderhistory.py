@@ -1,14 +1,25 @@
 """History of order ids,
  because Robokassa API let create only unique invoices
- (and after pay too)"""
-from typing import Union
+ (and after pay too).
+ order_id is unique: the record marks an activated order"""
+from datetime import datetime
+from typing import ClassVar, List, Optional, Union
 
 from pydantic import BaseModel
+from pymongo import ASCENDING, IndexModel
+
+ORDER_HISTORY_TTL = 365 * 24 * 60 * 60
 
 
 class OrderHistory(BaseModel):
     """
     OrderHistory model
     """
+    indexes: ClassVar[List[IndexModel]] = [
+        IndexModel([("order_id", ASCENDING)], unique=True),
+        IndexModel([("expire_at", ASCENDING)], expireAfterSeconds=0),
+    ]
+
     order_id: Union[int, None] = None
     created_at: float
+    expire_at: Optional[datetime] = None
@@ -1,13 +1,18 @@
 """Promo codes model"""
-from typing import Optional
+from typing import ClassVar, List, Optional
 
 from pydantic import BaseModel
+from pymongo import ASCENDING, IndexModel
 
 
 class PromoCodes(BaseModel):
     """
     PromoCodes model
     """
+    indexes: ClassVar[List[IndexModel]] = [
+        IndexModel([("promo_code", ASCENDING)], unique=True),
+    ]
+
     promo_code: str
     usages: Optional[int] = None
     period: Optional[int] = None
@@ -0,0 +1,25 @@
+"""Shared state record model (throttling and album parts of bot replicas)"""
+from datetime import datetime
+from typing import ClassVar, List, Optional
+
+from pydantic import BaseModel, Field
+from pymongo import ASCENDING, IndexModel
+
+
+class SharedStateRecord(BaseModel):
+    """
+    Shared state record, _id is "<kind>:<key>".
+    until: end of the throttling window,
+    parts: album messages (json), count: number of parts,
+    taken: the album was handled, late parts are dropped
+    """
+    indexes: ClassVar[List[IndexModel]] = [
+        IndexModel([("expire_at", ASCENDING)], expireAfterSeconds=0),
+    ]
+
+    until: float = 0.0
+    parts: List[dict] = Field(default_factory=list)
+    count: int = 0
+    updated_at: float = 0.0
+    taken: bool = False
+    expire_at: Optional[datetime] = None
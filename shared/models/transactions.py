@@ -1,14 +1,59 @@
 """Transactions model"""
+from datetime import datetime
+from typing import ClassVar, List, Optional
 
 from pydantic import BaseModel
+from pymongo import ASCENDING, IndexModel
+
+# the worker closes unpaid invoices after an hour,
+# TTL removes whatever it didn't get to
+TRANSACTION_TTL = 2 * 60 * 60
+
+# unpaid invoice is cancelled after an hour
+PAYMENT_TIMEOUT = 60 * 60
+
+# (invoice age, seconds between checks): payments are confirmed by
+# the ResultURL webhook, polling only reconciles missed notifications
+CHECK_SCHEDULE = [
+    (5 * 60, 30),
+    (15 * 60, 120),
+    (PAYMENT_TIMEOUT, 300),
+]
+
+# a paid order is claimed (status ACTIVATING) before the subscription is
+# activated, a claim older than CLAIM_TIMEOUT was abandoned and is retried
+ACTIVATING = "activating"
+CLAIM_TIMEOUT = 60
+
+
+def next_check_at(created_at: float, now: float) -> float:
+    """
+    Time of the next payment status check
+    :param created_at: invoice creation time
+    :param now:
+    :return: timestamp, never later than the payment timeout
+    """
+    age = now - created_at
+    delay = next((step for limit, step in CHECK_SCHEDULE if age < limit), CHECK_SCHEDULE[-1][1])
+    return min(now + delay, max(created_at + PAYMENT_TIMEOUT + 1, now + CHECK_SCHEDULE[0][1]))
 
 
 class Transactions(BaseModel):
     """
     Transactions model
     """
+    indexes: ClassVar[List[IndexModel]] = [
+        IndexModel([("order_id", ASCENDING)], unique=True),
+        IndexModel([("expire_at", ASCENDING)], expireAfterSeconds=0),
+        IndexModel([("next_check_at", ASCENDING)]),
+    ]
+
     order_id: int
     user_id: int
     period: int
     message_id: int
     created_at: float
+    expire_at: Optional[datetime] = None
+    next_check_at: Optional[float] = None
+    status: Optional[str] = None
+    claimed_at: Optional[float] = None
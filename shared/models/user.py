@@ -1,7 +1,8 @@
 """User database model"""
-from typing import Union, Optional
+from typing import ClassVar, List, Union, Optional
 
 from pydantic import BaseModel, Field
+from pymongo import ASCENDING, IndexModel
 
 
 class MessageIds(BaseModel):
@@ -15,6 +16,11 @@ class User(BaseModel):
     """
     User model
     """
+    indexes: ClassVar[List[IndexModel]] = [
+        IndexModel([("id", ASCENDING)], unique=True),
+        IndexModel([("subscription_end", ASCENDING)]),
+    ]
+
     id: int
     role: str = 'user'
     personal_month: Optional[int] = None
@@ -27,6 +33,7 @@ class User(BaseModel):
     subscribed: bool = False
     subscribed_date: Union[float, None] = None
     subscribed_period: Union[int, None] = None
+    subscription_end: Union[float, None] = None
     first_name: str
     last_name: Union[str, None] = None
     username: Union[str, None] = None
@@ -0,0 +1,138 @@
+"""Static assets registry.
+    The first send uploads the file and stores the returned Telegram file_id
+    (keyed by content hash), every next send reuses it.
+    A changed file gets a new hash and is uploaded again"""
+import hashlib
+import logging
+import os
+import time
+from typing import Dict, Tuple, Union
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest
+from aiogram.types import FSInputFile, Message
+
+from shared.utils.db import db, Collection
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+
+class AssetRegistry:
+    """
+    sha256 of the file -> Telegram file_id
+    """
+
+    def __init__(self, collection: Collection):
+        self.collection = collection
+        self.file_ids: Dict[str, str] = {}
+        self.hashes: Dict[str, Tuple[float, str]] = {}
+
+    def content_hash(self, path: str) -> str:
+        """
+        Hash of the file, recalculated only when mtime changes
+        :param path:
+        :return: sha256 hex digest
+        """
+        mtime = os.path.getmtime(path)
+        cached = self.hashes.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        with open(path, "rb") as file:
+            digest = hashlib.sha256(file.read()).hexdigest()
+        self.hashes[path] = (mtime, digest)
+        return digest
+
+    async def photo(self, path: str) -> Union[str, FSInputFile]:
+        """
+        Value for the photo/media argument
+        :param path:
+        :return: cached file_id or FSInputFile to upload
+        """
+        digest = self.content_hash(path)
+        file_id = self.file_ids.get(digest)
+        if file_id is None:
+            asset = await self.collection.find_one({"sha256": digest})
+            if asset:
+                file_id = self.file_ids[digest] = asset.file_id
+        return file_id or FSInputFile(path, filename=os.path.basename(path))
+
+    async def remember(self, path: str, message: Message):
+        """
+        Store file_id of the uploaded photo
+        :param path:
+        :param message: message returned by send_photo/edit_message_media
+        :return: None
+        """
+        if not isinstance(message, Message) or not message.photo:
+            return
+        digest = self.content_hash(path)
+        file_id = message.photo[-1].file_id
+        if self.file_ids.get(digest) == file_id:
+            return
+        self.file_ids[digest] = file_id
+        await self.collection.update_one({"sha256": digest},
+                                         {"file_id": file_id,
+                                          "name": os.path.basename(path),
+                                          "created_at": time.time()},
+                                         upsert=True)
+
+    async def forget(self, path: str):
+        """
+        Drop file_id that Telegram doesn't accept anymore
+        :param path:
+        :return: None
+        """
+        digest = self.content_hash(path)
+        self.file_ids.pop(digest, None)
+        await self.collection.delete_one({"sha256": digest})
+
+    async def send_photo(self, bot: Bot, chat_id: int, path: str, **kwargs) -> Message:
+        """
+        bot.send_photo with the cached file_id
+        :param bot:
+        :param chat_id:
+        :param path:
+        :param kwargs: caption, reply_markup, ...
+        :return: sent message
+        """
+        photo = await self.photo(path)
+        try:
+            message = await bot.send_photo(chat_id=chat_id, photo=photo, **kwargs)
+        except TelegramBadRequest as e:
+            if isinstance(photo, FSInputFile) or "file" not in e.message.lower():
+                raise
+            logger.warning("Cached file_id of %s rejected: %s", path, e.message)
+            await self.forget(path)
+            photo = await self.photo(path)
+            message = await bot.send_photo(chat_id=chat_id, photo=photo, **kwargs)
+        if isinstance(photo, FSInputFile):
+            await self.remember(path, message)
+        return message
+
+    async def warm_up(self, bot: Bot, chat_id: int, directory: str):
+        """
+        Upload images that have no file_id yet to the cache chat,
+        so users never wait for the upload
+        :param bot:
+        :param chat_id: CACHE_CHAT_ID
+        :param directory: assets directory
+        :return: None
+        """
+        for name in sorted(os.listdir(directory)):
+            if not name.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            path = os.path.join(directory, name)
+            photo = await self.photo(path)
+            if not isinstance(photo, FSInputFile):
+                continue
+            try:
+                message = await bot.send_photo(chat_id=chat_id, photo=photo)
+            except TelegramAPIError as e:
+                logger.warning("Asset %s upload to cache chat failed: %s", name, e)
+                continue
+            await self.remember(path, message)
+
+
+asset_registry = AssetRegistry(db.assets)
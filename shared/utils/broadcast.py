@@ -0,0 +1,221 @@
+"""Broadcast engine.
+    A broadcast is a persisted job with a cursor over users in id order.
+    Recipients are sent in batches, concurrently but within a token bucket
+    tuned to the Telegram global limit (~30 msg/s). The cursor and counters
+    are saved after every batch, so an interrupted broadcast resumes
+    from the last finished batch.
+    Broadcasts run in the worker process as "broadcast" jobs (shared/utils/jobs.py).
+    The token bucket lives in the worker process, so the global limit holds
+    only with a single worker instance"""
+import asyncio
+import logging
+import time
+import uuid
+
+from aiogram import Bot
+from aiogram.exceptions import (TelegramAPIError, TelegramBadRequest,
+                                TelegramForbiddenError, TelegramRetryAfter)
+from aiogram.types import InlineKeyboardButton
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+from fluentogram import TranslatorRunner
+
+from shared.models.broadcast import Broadcast
+from shared.models.job import Job
+from shared.utils.callbacks import Start
+from shared.utils.config import settings
+from shared.utils.db import db
+from shared.utils.i18n import get_locale
+from shared.utils.jobs import enqueue
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_INTERVAL = 5.0
+SEND_ATTEMPTS = 3
+
+
+class TokenBucket:
+    """
+    Token bucket shared by all broadcasts of the process.
+    Not shared between processes: run a single worker instance
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        """
+        Wait for a token
+        :return: None
+        """
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """
+        Stop handing out tokens (RetryAfter from Telegram)
+        :param seconds:
+        :return: None
+        """
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+bucket = TokenBucket(rate=settings.BROADCAST_RATE, capacity=settings.BROADCAST_RATE)
+
+
+def progress_text(broadcast: Broadcast, locale: TranslatorRunner) -> str:
+    """
+    Progress / result message
+    :param broadcast:
+    :param locale:
+    :return: text
+    """
+    counters = broadcast.model_dump(include={"total", "sent", "blocked", "failed"})
+    if broadcast.status == "done":
+        return locale.mailing.done(**counters)
+    return locale.mailing.progress(**counters)
+
+
+async def create_broadcast(admin_id: int, message_id: int,
+                           progress_message_id: int) -> Broadcast:
+    """
+    Persist a new broadcast and enqueue it for the worker
+    :param admin_id: admin chat, source of the message
+    :param message_id: message to copy
+    :param progress_message_id: message to edit with progress
+    :return: Broadcast
+    """
+    broadcast = Broadcast(id=uuid.uuid4().hex,
+                          admin_id=admin_id,
+                          from_chat_id=admin_id,
+                          message_id=message_id,
+                          progress_message_id=progress_message_id,
+                          created_at=time.time(),
+                          updated_at=time.time())
+    await db.broadcasts.insert_one(broadcast.model_dump())
+    await enqueue("broadcast", {"broadcast_id": broadcast.id})
+    return broadcast
+
+
+async def send_to_user(bot: Bot, broadcast: Broadcast, user_id: int) -> str:
+    """
+    Copy the broadcast message to one user
+    :param bot:
+    :param broadcast:
+    :param user_id:
+    :return: "sent", "blocked" or "failed"
+    """
+    for _ in range(SEND_ATTEMPTS):
+        await bucket.acquire()
+        try:
+            await bot.copy_message(chat_id=user_id,
+                                   from_chat_id=broadcast.from_chat_id,
+                                   message_id=broadcast.message_id)
+            return "sent"
+        except TelegramRetryAfter as e:
+            logger.warning("Broadcast %s: RetryAfter %s", broadcast.id, e.retry_after)
+            bucket.pause(e.retry_after)
+        except TelegramForbiddenError:
+            await db.users.update_one({"id": user_id}, {"blocked_at": int(time.time())})
+            return "blocked"
+        except TelegramAPIError:
+            return "failed"
+    return "failed"
+
+
+async def report_progress(bot: Bot, broadcast: Broadcast, locale: TranslatorRunner):
+    """
+    Edit the progress message
+    :param bot:
+    :param broadcast:
+    :param locale:
+    :return: None
+    """
+    done = broadcast.status == "done"
+    builder = InlineKeyboardBuilder()
+    builder.row(InlineKeyboardButton(text=locale.mailing.back(), callback_data=Start().pack()))
+    try:
+        await bot.edit_message_text(chat_id=broadcast.admin_id,
+                                    message_id=broadcast.progress_message_id,
+                                    text=progress_text(broadcast, locale),
+                                    reply_markup=builder.as_markup() if done else None)
+    except TelegramBadRequest:
+        pass
+    except TelegramRetryAfter as e:
+        bucket.pause(e.retry_after)
+
+
+async def run_broadcast(bot: Bot, broadcast: Broadcast, locale: TranslatorRunner):
+    """
+    Send the broadcast from its cursor to the end of the users collection
+    :param bot:
+    :param broadcast:
+    :param locale:
+    :return: None
+    """
+    semaphore = asyncio.Semaphore(settings.BROADCAST_CONCURRENCY)
+
+    async def send(user_id: int) -> str:
+        async with semaphore:
+            return await send_to_user(bot, broadcast, user_id)
+
+    last_report = time.monotonic()
+    while True:
+        f = {"blocked_at": None}
+        if broadcast.cursor is not None:
+            f["id"] = {"$gt": broadcast.cursor}
+        batch = await db.users.find(f, count=settings.BROADCAST_BATCH_SIZE,
+                                    projection={"id": 1, "_id": 0}, raw=True,
+                                    sort=[("id", 1)])
+        if not batch:
+            break
+        results = await asyncio.gather(*(send(user["id"]) for user in batch))
+        broadcast.cursor = batch[-1]["id"]
+        broadcast.total += len(results)
+        broadcast.sent += results.count("sent")
+        broadcast.blocked += results.count("blocked")
+        broadcast.failed += results.count("failed")
+        broadcast.updated_at = time.time()
+        await db.broadcasts.update_one({"id": broadcast.id},
+                                       broadcast.model_dump(include={"cursor", "total", "sent",
+                                                                     "blocked", "failed",
+                                                                     "updated_at"}))
+        if time.monotonic() - last_report >= PROGRESS_INTERVAL:
+            await report_progress(bot, broadcast, locale)
+            last_report = time.monotonic()
+
+    broadcast.status = "done"
+    await db.broadcasts.update_one({"id": broadcast.id},
+                                   {"status": "done", "updated_at": time.time()})
+    await report_progress(bot, broadcast, locale)
+    logger.info("Broadcast %s done: %s sent of %s", broadcast.id, broadcast.sent, broadcast.total)
+
+
+async def broadcast_job(bot: Bot, job: Job):
+    """
+    Job handler, runs (or resumes) job.payload["broadcast_id"]
+    :param bot:
+    :param job:
+    :return: None
+    """
+    broadcast = await db.broadcasts.find_one({"id": job.payload["broadcast_id"]})
+    if broadcast is None or broadcast.status == "done":
+        return
+    if broadcast.cursor is not None:
+        logger.info("Resuming broadcast %s from user %s", broadcast.id, broadcast.cursor)
+    await run_broadcast(bot, broadcast, get_locale())
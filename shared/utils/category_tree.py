@@ -0,0 +1,198 @@
+"""In-memory category tree.
+    Navigation reads categories from here instead of MongoDB.
+    The tree is loaded once at startup and kept fresh by the change stream
+    of the category collection (or by polling updated_at without replica set).
+    Every change drops the cached keyboards of the affected nodes
+    and the prepared render plan of the node"""
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+from shared.models.category import CategoryModel
+from shared.utils.db import db, Collection
+from shared.utils.keyboard_cache import keyboard_cache
+from shared.utils.render_plan import PreparedStep, compile_render_plan, prepare
+
+logger = logging.getLogger(__name__)
+
+
+class CategoryTree:
+    """
+    id -> node and parent_id -> ordered children index
+    """
+
+    def __init__(self, collection: Collection):
+        self.collection = collection
+        self.nodes: Dict[str, CategoryModel] = {}
+        self.children: Dict[Optional[str], List[str]] = {}
+        self.object_ids: Dict[str, str] = {}
+        self.plans: Dict[str, List[PreparedStep]] = {}
+        self.watermark: float = 0.0
+
+    def get(self, category_id: Optional[str]) -> Optional[CategoryModel]:
+        """
+        Category by id
+        :param category_id:
+        :return: CategoryModel or None
+        """
+        return self.nodes.get(category_id)
+
+    def children_of(self, parent_id: Optional[str]) -> List[CategoryModel]:
+        """
+        Child categories in creation order
+        :param parent_id:
+        :return: list of CategoryModel
+        """
+        return [self.nodes[category_id] for category_id in self.children.get(parent_id, [])]
+
+    def render_plan(self, category_id: Optional[str]) -> List[PreparedStep]:
+        """
+        Prepared render plan of the category.
+        Categories saved before render plans existed are compiled on the fly
+        :param category_id:
+        :return: (method, kwargs) sends
+        """
+        plan = self.plans.get(category_id)
+        if plan is None:
+            node = self.nodes.get(category_id)
+            if node is None:
+                return []
+            plan = self.plans[category_id] = prepare(
+                node.render_plan if node.render_plan is not None else compile_render_plan(node))
+        return plan
+
+    async def compile(self, category_id: str):
+        """
+        Re-read the category after the admin changed its content,
+        compile and store its render plan
+        :param category_id:
+        :return: None
+        """
+        await self.refresh(category_id)
+        node = self.nodes.get(category_id)
+        if node is None:
+            return
+        plan = compile_render_plan(node)
+        await self.collection.update_one({"id": category_id},
+                                         {"render_plan": [step.model_dump() for step in plan]})
+        self._store({**node.model_dump(), "render_plan": [step.model_dump() for step in plan]})
+
+    async def load(self):
+        """
+        Full reload of the tree from MongoDB
+        :return: None
+        """
+        started = time.time()
+        documents = await self.collection.collection.find({}).to_list(length=None)
+        self.nodes, self.children, self.object_ids, self.plans = {}, {}, {}, {}
+        for document in documents:
+            self._store(document)
+        keyboard_cache.clear()
+        self.watermark = started - 1.0
+        logger.info("Category tree loaded: %s nodes", len(self.nodes))
+
+    async def refresh(self, category_id: str):
+        """
+        Re-read one category after a local write,
+        so the next render doesn't wait for the change stream
+        :param category_id:
+        :return: None
+        """
+        document = await self.collection.collection.find_one({"id": category_id})
+        if document:
+            self._store(document)
+        else:
+            self.discard(category_id)
+
+    def discard(self, category_id: str):
+        """
+        Remove category from the tree
+        :param category_id:
+        :return: None
+        """
+        node = self.nodes.pop(category_id, None)
+        self.plans.pop(category_id, None)
+        if node is None:
+            return
+        siblings = self.children.get(node.parent_id, [])
+        if category_id in siblings:
+            siblings.remove(category_id)
+        keyboard_cache.invalidate(category_id, node.parent_id, *self.children.get(category_id, []))
+        self.object_ids = {object_id: node_id for object_id, node_id in self.object_ids.items()
+                           if node_id != category_id}
+
+    def apply_change(self, change: dict):
+        """
+        Apply a change stream event
+        :param change:
+        :return: None
+        """
+        operation = change["operationType"]
+        if operation in ("insert", "update", "replace"):
+            if change.get("fullDocument"):
+                self._store(change["fullDocument"])
+        elif operation == "delete":
+            category_id = self.object_ids.get(str(change["documentKey"]["_id"]))
+            if category_id:
+                self.discard(category_id)
+        elif operation in ("drop", "dropDatabase"):
+            self.nodes, self.children, self.object_ids, self.plans = {}, {}, {}, {}
+            keyboard_cache.clear()
+
+    async def poll(self):
+        """
+        Apply categories created or updated since the last poll.
+        Deletions are detected by the document count
+        :return: None
+        """
+        started = time.time()
+        documents = await self.collection.collection.find(
+            {"$or": [{"updated_at": {"$gt": self.watermark}},
+                     {"created_at": {"$gt": self.watermark}}]}).to_list(length=None)
+        for document in documents:
+            self._store(document)
+        if await self.collection.count({"id": {"$ne": None}}) != len(self.nodes):
+            await self.load()
+            return
+        self.watermark = started - 1.0
+
+    async def watch(self, poll_interval: float = 5.0):
+        """
+        Keep the tree fresh for the process lifetime
+        :param poll_interval: seconds between polls without change streams
+        :return: None
+        """
+        try:
+            await self.collection.watch(self.apply_change, full_document="updateLookup")
+        except OperationFailure as e:
+            logger.info("Category change stream unavailable (%s), polling updated_at", e)
+        while True:
+            await asyncio.sleep(poll_interval)
+            try:
+                await self.poll()
+            except PyMongoError as e:
+                logger.warning("Category tree poll failed: %s", e)
+
+    def _store(self, document: dict):
+        if not document.get("id"):
+            return
+        object_id = str(document.pop("_id", ""))
+        node = CategoryModel(**document)
+        previous = self.nodes.get(node.id)
+        if previous is None or previous.parent_id != node.parent_id:
+            if previous is not None:
+                self.children.get(previous.parent_id, []).remove(node.id)
+            self.children.setdefault(node.parent_id, []).append(node.id)
+        self.nodes[node.id] = node
+        self.plans.pop(node.id, None)
+        keyboard_cache.invalidate(node.id, node.parent_id, *self.children.get(node.id, []))
+        if previous is not None and previous.parent_id != node.parent_id:
+            keyboard_cache.invalidate(previous.parent_id)
+        if object_id:
+            self.object_ids[object_id] = node.id
+
+
+category_tree = CategoryTree(db.category)
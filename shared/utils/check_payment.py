@@ -1,50 +1,97 @@
 """Worker functions"""
 import hashlib
+import logging
+from typing import Optional
 from xml.etree.ElementTree import ParseError
 from xml.etree import ElementTree
 import asyncio
 import aiohttp
 
+from shared.utils.config import Settings
 
-async def check_payment_status(merchant_login, invoice_id, password2):
+logger = logging.getLogger(__name__)
+
+NAMESPACE = {'ns': 'http://merchant.roboxchange.com/WebService/'}
+
+
+class RobokassaClient:
     """
-    Function to check payment status asynchronously.
-    :param merchant_login: Merchant's login
-    :param invoice_id: Invoice ID
-    :param password2: Second password for signature
-    :return: payment_status: code
+    Long-lived Robokassa WebService client.
+    One keep-alive connection pool for the whole worker lifetime,
+    ROBOKASSA_STATUS_URL can point to a local stub server
     """
-    signature_string = f"{merchant_login}:{invoice_id}:{password2}"
-    signature = hashlib.md5(signature_string.encode('utf-8')).hexdigest()
 
-    url = "https://auth.robokassa.ru/Merchant/WebService/Service.asmx/OpStateExt"
-    params = {
-        "MerchantLogin": merchant_login,
-        "InvoiceID": invoice_id,
-        "Signature": signature
-    }
+    def __init__(self, config: Settings, keepalive_timeout: float = 60.0):
+        self.merchant_login = config.ROBOKASSA_LOGIN
+        self.password2 = config.ROBOKASSA_PASSWORD_2
+        self.base_url = config.ROBOKASSA_STATUS_URL
+        self.timeout = aiohttp.ClientTimeout(total=config.ROBOKASSA_TIMEOUT)
+        self.limit_per_host = config.ROBOKASSA_CONNECTIONS
+        self.keepalive_timeout = keepalive_timeout
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """
+        Shared session, created on first use inside the running loop
+        :return: aiohttp.ClientSession
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit_per_host * 2,
+                                             limit_per_host=self.limit_per_host,
+                                             keepalive_timeout=self.keepalive_timeout,
+                                             ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+
+    async def close(self):
+        """
+        Close the connection pool
+        :return: None
+        """
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def check_payment_status(self, invoice_id) -> Optional[int]:
+        """
+        Function to check payment status asynchronously.
+        :param invoice_id: Invoice ID
+        :return: payment_status: code
+        """
+        signature_string = f"{self.merchant_login}:{invoice_id}:{self.password2}"
+        signature = hashlib.md5(signature_string.encode('utf-8')).hexdigest()
+
+        params = {
+            "MerchantLogin": self.merchant_login,
+            "InvoiceID": invoice_id,
+            "Signature": signature
+        }
 
-    async with aiohttp.ClientSession() as session:
         try:
-            async with session.get(url, params=params, timeout=10) as response:
+            async with self.session.get(self.base_url, params=params) as response:
                 response.raise_for_status()
                 content = await response.text()
 
                 try:
                     root = ElementTree.fromstring(content)
-                    namespace = {'ns': 'http://merchant.roboxchange.com/WebService/'}
-                    state_code = root.find('.//ns:State/ns:Code', namespace)
+                    state_code = root.find('.//ns:State/ns:Code', NAMESPACE)
                     if state_code is not None:
                         return int(state_code.text)
 
                     return None
                 except ParseError as e:
-                    print(f"XML parsing error: {e}")
+                    logger.error("XML parsing error: %s", e)
                     return None
 
         except asyncio.TimeoutError:
-            print("Request timed out.")
+            logger.error("Request timed out: %s", invoice_id)
             return None
         except aiohttp.ClientError as e:
-            print(f"Request error: {e}")
+            logger.error("Request error: %s", e)
             return None
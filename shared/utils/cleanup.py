@@ -0,0 +1,74 @@
+"""Message cleanup engine.
+    Previous content messages are removed with the batch deleteMessages
+    method (100 ids per call) in a background task, so the new content
+    is not blocked on the cleanup"""
+import asyncio
+import logging
+from typing import List, Set
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 100
+
+background_tasks: Set[asyncio.Task] = set()
+
+
+async def delete_one_by_one(bot: Bot, chat_id: int, message_ids: List[int],
+                            concurrency: int = 5):
+    """
+    Single deletes with bounded concurrency
+    :param bot:
+    :param chat_id:
+    :param message_ids:
+    :param concurrency: parallel deleteMessage calls
+    :return: None
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def delete(message_id: int):
+        async with semaphore:
+            try:
+                await bot.delete_message(chat_id=chat_id, message_id=message_id)
+            except TelegramBadRequest:
+                pass
+
+    await asyncio.gather(*(delete(message_id) for message_id in message_ids))
+
+
+async def delete_messages(bot: Bot, chat_id: int, message_ids: List[int]):
+    """
+    Delete messages in chunks of 100,
+    falling back to single deletes when the batch call is rejected
+    :param bot:
+    :param chat_id:
+    :param message_ids:
+    :return: None
+    """
+    for start in range(0, len(message_ids), BATCH_SIZE):
+        chunk = message_ids[start:start + BATCH_SIZE]
+        try:
+            await bot.delete_messages(chat_id=chat_id, message_ids=chunk)
+        except TelegramBadRequest:
+            await delete_one_by_one(bot, chat_id, chunk)
+
+
+def delete_in_background(bot: Bot, chat_id: int, message_ids: List[int]):
+    """
+    Schedule delete_messages without waiting for it
+    :param bot:
+    :param chat_id:
+    :param message_ids:
+    :return: None
+    """
+    async def run():
+        try:
+            await delete_messages(bot, chat_id, message_ids)
+        except TelegramAPIError as e:
+            logger.warning("Message cleanup for %s failed: %s", chat_id, e)
+
+    task = asyncio.create_task(run())
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
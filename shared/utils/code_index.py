@@ -0,0 +1,216 @@
+"""Promo code and discount lookup index.
+    Codes entered by users are resolved in memory: existing promo codes
+    and discounts are loaded at startup and kept fresh by change streams
+    (or periodic reload without replica set). Unknown codes are remembered
+    in a bounded TTL cache, so mistyped and brute-force codes don't reach
+    MongoDB. Usages are not cached, redemption stays atomic in the db.
+    A miss is trusted only while both change streams are open, otherwise
+    the code is looked up in the db"""
+import asyncio
+import logging
+from functools import partial
+from typing import Dict, Optional, Set
+
+from cachetools import TTLCache
+from pymongo.errors import OperationFailure, PyMongoError
+
+from shared.models.discounts import Discounts
+from shared.utils.config import settings
+from shared.utils.db import db, Collection
+
+logger = logging.getLogger(__name__)
+
+STREAMS = ("promo_codes", "discounts")
+
+
+class CodeIndex:
+    """
+    promo codes, code -> discount and negative cache of unknown codes
+    """
+
+    def __init__(self, promo_codes: Collection, discounts: Collection,
+                 negative_size: int = 10_000, negative_ttl: float = 60.0):
+        self.promo_codes_collection = promo_codes
+        self.discounts_collection = discounts
+        self.promo_codes: Set[str] = set()
+        self.discounts: Dict[str, Discounts] = {}
+        self.missing = TTLCache(maxsize=negative_size, ttl=negative_ttl)
+        self.streams: Dict[str, bool] = {}
+        self.reload_task: Optional[asyncio.Task] = None
+
+    @property
+    def live(self) -> bool:
+        """
+        Both change streams are open, so the index is complete
+        :return: bool
+        """
+        return all(self.streams.get(name) for name in STREAMS)
+
+    def stream_status(self, name: str, is_open: bool):
+        """
+        Track a change stream; changes made before it (re)opened are reloaded
+        :param name: collection name
+        :param is_open:
+        :return: None
+        """
+        if is_open and not self.streams.get(name):
+            self.schedule_reload()
+        self.streams[name] = is_open
+
+    async def load(self):
+        """
+        Full reload of the index
+        :return: None
+        """
+        promo_codes = await self.promo_codes_collection.find({},
+                                                             projection={"promo_code": 1,
+                                                                         "_id": 0},
+                                                             raw=True)
+        discounts = await self.discounts_collection.find({})
+        self.promo_codes = {item["promo_code"] for item in promo_codes}
+        self.discounts = {discount.promo_code: discount for discount in discounts}
+        self.missing.clear()
+        logger.info("Code index loaded: %s promo codes, %s discounts",
+                    len(self.promo_codes), len(self.discounts))
+
+    async def is_promo_code(self, code: str) -> bool:
+        """
+        Whether the promo code exists
+        :param code:
+        :return: bool
+        """
+        if code in self.promo_codes:
+            return True
+        if self.live or ("promo", code) in self.missing:
+            return False
+        if await self.promo_codes_collection.find_one({"promo_code": code},
+                                                      projection={"_id": 1}, raw=True):
+            self.promo_codes.add(code)
+            return True
+        self.missing[("promo", code)] = True
+        return False
+
+    async def discount(self, code: str) -> Optional[Discounts]:
+        """
+        Discount by code
+        :param code: lower case code
+        :return: Discounts or None
+        """
+        discount = self.discounts.get(code)
+        if discount or self.live or ("discount", code) in self.missing:
+            return discount
+        discount = await self.discounts_collection.find_one({"promo_code": code})
+        if discount:
+            self.discounts[code] = discount
+        else:
+            self.missing[("discount", code)] = True
+        return discount
+
+    async def refresh_promo_code(self, code: str):
+        """
+        Re-read promo code after a local write
+        :param code:
+        :return: None
+        """
+        self.missing.pop(("promo", code), None)
+        if await self.promo_codes_collection.find_one({"promo_code": code},
+                                                      projection={"_id": 1}, raw=True):
+            self.promo_codes.add(code)
+        else:
+            self.promo_codes.discard(code)
+
+    async def refresh_discount(self, code: str):
+        """
+        Re-read discount after a local write
+        :param code:
+        :return: None
+        """
+        self.missing.pop(("discount", code), None)
+        discount = await self.discounts_collection.find_one({"promo_code": code})
+        if discount:
+            self.discounts[code] = discount
+        else:
+            self.discounts.pop(code, None)
+
+    def discard_promo_code(self, code: str):
+        """
+        Forget deleted promo code
+        :param code:
+        :return: None
+        """
+        self.promo_codes.discard(code)
+
+    def apply_promo_change(self, change: dict):
+        """
+        Apply a change stream event of promo_codes
+        :param change:
+        :return: None
+        """
+        if change.get("fullDocument"):
+            code = change["fullDocument"]["promo_code"]
+            self.promo_codes.add(code)
+            self.missing.pop(("promo", code), None)
+        elif change["operationType"] != "update":
+            self.schedule_reload()
+
+    def apply_discount_change(self, change: dict):
+        """
+        Apply a change stream event of discounts
+        :param change:
+        :return: None
+        """
+        if change.get("fullDocument"):
+            document = dict(change["fullDocument"])
+            document.pop("_id", None)
+            discount = Discounts(**document)
+            self.discounts[discount.promo_code] = discount
+            self.missing.pop(("discount", discount.promo_code), None)
+        elif change["operationType"] != "update":
+            self.schedule_reload()
+
+    def schedule_reload(self):
+        """
+        Start a full reload unless one is already running
+        :return: None
+        """
+        if self.reload_task is None or self.reload_task.done():
+            self.reload_task = asyncio.create_task(self.reload())
+
+    async def reload(self):
+        """
+        load() that only logs failures
+        :return: None
+        """
+        try:
+            await self.load()
+        except PyMongoError as e:
+            logger.warning("Code index reload failed: %s", e)
+
+    async def watch(self, poll_interval: float = 60.0):
+        """
+        Keep the index fresh for the process lifetime.
+        Deletions are rare (exhausted codes), they trigger a full reload
+        :param poll_interval: seconds between reloads without change streams
+        :return: None
+        """
+        try:
+            await asyncio.gather(
+                self.promo_codes_collection.watch(self.apply_promo_change,
+                                                  full_document="updateLookup",
+                                                  on_status=partial(self.stream_status,
+                                                                    "promo_codes")),
+                self.discounts_collection.watch(self.apply_discount_change,
+                                                full_document="updateLookup",
+                                                on_status=partial(self.stream_status,
+                                                                  "discounts")))
+        except OperationFailure as e:
+            self.streams.clear()
+            logger.info("Code change streams unavailable (%s), reloading every %ss",
+                        e, poll_interval)
+        while True:
+            await asyncio.sleep(poll_interval)
+            await self.reload()
+
+
+code_index = CodeIndex(db.promo_codes, db.discounts,
+                       negative_ttl=settings.CODE_NEGATIVE_TTL)
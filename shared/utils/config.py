@@ -1,5 +1,6 @@
 """ENV SETTINGS"""
-from typing import List
+from typing import List, Literal, Optional
+from pydantic import model_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -8,6 +9,14 @@ class Settings(BaseSettings):
     Settings class
     """
     BOT_TOKEN: str
+    BOT_MODE: Literal["polling", "webhook"] = "polling"
+
+    WEBHOOK_URL: str = ""
+    WEBHOOK_PATH: str = "/webhook"
+    WEBHOOK_SECRET: Optional[str] = None
+    WEBHOOK_HOST: str = "0.0.0.0"
+    WEBHOOK_PORT: int = 8081
+    METRICS_PORT: int = 9100
 
     MONGO_USERNAME: str
     MONGO_PASSWORD: str
@@ -20,12 +29,40 @@ class Settings(BaseSettings):
 
     ADMIN_IDS: List[int]
     CACHE_CHAT_ID: int
+    USER_CACHE_TTL: float = 10.0
+    CODE_NEGATIVE_TTL: float = 60.0
+    # FSM read cache, single bot replica only
+    FSM_CACHE_TTL: float = 0.0
+    STATE_BACKEND: Literal["memory", "mongo"] = "memory"
+    MEDIA_SEND_CONCURRENCY: int = 4
 
     ROBOKASSA_LOGIN: str
     ROBOKASSA_PASSWORD_1: str
     ROBOKASSA_PASSWORD_2: str
+    ROBOKASSA_STATUS_URL: str = ("https://auth.robokassa.ru/Merchant/WebService/"
+                                 "Service.asmx/OpStateExt")
+    ROBOKASSA_TIMEOUT: float = 10.0
+    ROBOKASSA_CONNECTIONS: int = 20
+    PAYMENT_CHECK_CONCURRENCY: int = 10
+
+    WORKER_WEB_HOST: str = "0.0.0.0"
+    WORKER_WEB_PORT: int = 8080
+
+    BROADCAST_RATE: float = 25.0
+    BROADCAST_CONCURRENCY: int = 20
+    BROADCAST_BATCH_SIZE: int = 100
 
     model_config = SettingsConfigDict(env_file="/app/.env")
 
+    @model_validator(mode="after")
+    def check_webhook_secret(self):
+        """
+        Webhook mode accepts updates only with the secret token header
+        :return: settings
+        """
+        if self.BOT_MODE == "webhook" and not self.WEBHOOK_SECRET:
+            raise ValueError("WEBHOOK_SECRET is required when BOT_MODE=webhook")
+        return self
+
 
 settings = Settings()
@@ -1,19 +1,33 @@
 """MongoDb Custom ORM for simple use collection
     You can use db.collection.method({})"""
-from typing import List, Any
+import asyncio
+import logging
+from typing import List, Any, Callable, Optional
 
 import motor.motor_asyncio
 
 from pydantic import BaseModel
+from pymongo import ReturnDocument
+from pymongo.errors import OperationFailure, PyMongoError
 
+from shared.models.asset import Asset
+from shared.models.broadcast import Broadcast
 from shared.models.category import CategoryModel
 from shared.models.config_admin import ConfigAdmin
 from shared.models.discounts import Discounts
+from shared.models.fsm import FsmRecord
+from shared.models.job import Job
 from shared.models.orderhistory import OrderHistory
 from shared.models.promocodes import PromoCodes
+from shared.models.shared_state import SharedStateRecord
 from shared.models.transactions import Transactions
 from shared.models.user import User
 from shared.utils.config import settings
+from shared.utils.tracing import db_timed
+from shared.utils.user_cache import user_cache
+
+# an index with this name exists with other keys or options
+INDEX_KEY_SPECS_CONFLICT = 86
 
 client = motor.motor_asyncio.AsyncIOMotorClient(
     f'mongodb://{settings.MONGO_USERNAME}:'
@@ -35,40 +49,130 @@ class Collection:
     Methods MongoDb
     """
 
-    def __init__(self, model, collection_name: str):
+    def __init__(self, model, collection_name: str, cache=None):
         self.collection = client[settings.MONGO_DB_NAME][collection_name]
         self.model = model
+        self.cache = cache
+
+    def _cache_key(self, f: dict):
+        """
+        Cache key for {"id": value} filters
+        :param f:
+        :return: id or None
+        """
+        if self.cache is None or list(f) != ["id"] or isinstance(f["id"], dict):
+            return None
+        return f["id"]
+
+    def _write_through(self, f: dict, s: Optional[dict] = None):
+        """
+        Keep the cache in sync with a write
+        :param f: filter of the write
+        :param s: $set fields, None if the document was changed otherwise
+        :return: None
+        """
+        if self.cache is None:
+            return
+        key = self._cache_key(f)
+        if key is None:
+            self.cache.clear()
+        elif s is None:
+            self.cache.evict(key)
+        else:
+            self.cache.apply(key, s)
+
+    def _build(self, data: dict, projection: Optional[dict] = None, raw: bool = False):
+        """
+        Document -> model.
+        Projected documents skip validation (model_construct),
+        raw=True returns the dict as is
+        :param data:
+        :param projection:
+        :param raw:
+        :return: model or dict
+        """
+        if '_id' in data:
+            data['_id'] = str(data['_id'])
+        if raw:
+            return data
+        if projection:
+            return self.model.model_construct(**data)
+        return self.model(**data)
 
-    async def find_one(self, f: dict):
+    @db_timed(operation="find_one")
+    async def _find_one(self, f: dict, projection: Optional[dict] = None):
+        """
+        await db.collection.find_one, timed apart from cache hits
+        :param f:
+        :param projection:
+        :return: document or None
+        """
+        return await self.collection.find_one(f, projection)
+
+    async def find_one(self, f: dict, projection: Optional[dict] = None, raw: bool = False):
         """
         await db.collection.find_one
         :param f:
+        :param projection: fields to fetch, e.g. {"subscribed": 1}, projected reads skip the cache
+        :param raw: return dict instead of the model
         :return: an instance of the model (self.model) or None if no document is found.
 
         """
-        data = await self.collection.find_one(f)
+        key = None if projection else self._cache_key(f)
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached.model_dump() if raw else cached
+        data = await self._find_one(f, projection)
         if not data:
             return None
-        data['_id'] = str(data['_id'])
-        model = self.model(**data)
+        model = self._build(data, projection, raw)
+        if key is not None and not projection and not raw:
+            self.cache.put(key, model)
         return model
 
-    async def find(self, f: dict, count: int = 100000, offset: int = 0) -> List:
+    @db_timed
+    async def find(self, f: dict, count: int = 100000, offset: int = 0, *,  # pylint: disable=too-many-arguments
+                   projection: Optional[dict] = None, raw: bool = False,
+                   sort: Optional[list] = None) -> List:
         """
         await db.collection.find
         :param f:
         :param count:
         :param offset:
+        :param projection: fields to fetch, e.g. {"id": 1}
+        :param raw: return dicts instead of models
+        :param sort: e.g. [("id", 1)]
         :return: a list of instances of the model (self.model).
         """
-        cursor = self.collection.find(f).skip(offset).limit(count)
+        cursor = self.collection.find(f, projection)
+        if sort:
+            cursor = cursor.sort(sort)
+        cursor = cursor.skip(offset).limit(count)
         data = await cursor.to_list(length=count)
-        list_models = []
-        for item in data:
-            item['_id'] = str(item['_id'])
-            list_models.append(self.model(**item))
-        return list_models
+        return [self._build(item, projection, raw) for item in data]
+
+    async def iter(self, f: dict, projection: Optional[dict] = None,
+                   batch_size: int = 1000, raw: bool = False,
+                   sort: Optional[list] = None):
+        """
+        async for item in db.collection.iter
+        Streams the cursor batch by batch, so memory stays flat
+        regardless of the collection size
+        :param f:
+        :param projection: fields to fetch
+        :param batch_size: documents per cursor batch
+        :param raw: yield dicts instead of models
+        :param sort: e.g. [("id", 1)]
+        :return: async generator of models (or dicts)
+        """
+        cursor = self.collection.find(f, projection, batch_size=batch_size)
+        if sort:
+            cursor = cursor.sort(sort)
+        async for item in cursor:
+            yield self._build(item, projection, raw)
 
+    @db_timed
     async def update_one(self, f: dict, s: dict, upsert: bool = False):
         """
         await db.collection.update_one
@@ -78,8 +182,10 @@ class Collection:
         :return: the result of the operation (UpdateResult).
         """
         res = await self.collection.update_one(f, {'$set': s}, upsert=upsert)
+        self._write_through(f, s)
         return res
 
+    @db_timed
     async def delete_one(self, f: dict, ):
         """
         await db.collection.delete_one
@@ -87,8 +193,10 @@ class Collection:
         :return: the result of the operation (DeleteResult).
         """
         res = await self.collection.delete_one(f)
+        self._write_through(f)
         return res
 
+    @db_timed
     async def delete_many(self, f: dict, ):
         """
         await db.collection.delete_many
@@ -96,8 +204,10 @@ class Collection:
         :return: the result of the operation (DeleteResult).
         """
         res = await self.collection.delete_many(f)
+        self._write_through(f)
         return res
 
+    @db_timed
     async def update_many(self, f: dict, s: dict):
         """
         await db.collection.update_many
@@ -106,8 +216,47 @@ class Collection:
         :return: the result of the operation (UpdateResult).
         """
         res = await self.collection.update_many(f, s)
+        self._write_through(f)
         return res
 
+    @db_timed
+    async def find_one_and_update(self, f: dict, s: dict, upsert: bool = False,
+                                  return_new: bool = False, sort: Optional[list] = None):
+        """
+        await db.collection.find_one_and_update
+        :param f:
+        :param s: update document with operators ($set, $inc, ...)
+        :param upsert:
+        :param return_new: return the document after the update instead of before
+        :param sort: which document to take when several match
+        :return: an instance of the model (self.model) or None if no document is found.
+        """
+        data = await self.collection.find_one_and_update(
+            f, s, upsert=upsert, sort=sort,
+            return_document=ReturnDocument.AFTER if return_new else ReturnDocument.BEFORE)
+        self._write_through(f, s["$set"] if list(s) == ["$set"] else None)
+        if not data:
+            return None
+        data['_id'] = str(data['_id'])
+        return self.model(**data)
+
+    @db_timed
+    async def find_one_and_delete(self, f: dict, sort: Optional[list] = None):
+        """
+        await db.collection.find_one_and_delete
+        Atomic claim: only one of concurrent callers gets the document
+        :param f:
+        :param sort: which document to take when several match
+        :return: an instance of the model (self.model) or None if no document is found.
+        """
+        data = await self.collection.find_one_and_delete(f, sort=sort)
+        self._write_through(f)
+        if not data:
+            return None
+        data['_id'] = str(data['_id'])
+        return self.model(**data)
+
+    @db_timed
     async def count(self, f: dict):
         """
         return count of collection
@@ -117,6 +266,7 @@ class Collection:
         res = await self.collection.count_documents(f)
         return res
 
+    @db_timed
     async def insert_one(self, i: dict):
         """
         await db.collection.insert_one
@@ -126,6 +276,19 @@ class Collection:
         res = await self.collection.insert_one(i)
         return res
 
+    @db_timed
+    async def bulk_write(self, requests: list, ordered: bool = False):
+        """
+        await db.collection.bulk_write
+        :param requests: pymongo operations (UpdateOne, InsertOne, ...)
+        :param ordered: stop on the first error
+        :return: the result of the operation (BulkWriteResult).
+        """
+        res = await self.collection.bulk_write(requests, ordered=ordered)
+        self._write_through({})
+        return res
+
+    @db_timed
     async def push(self, criteria: dict, field: str, values: list, upsert: bool = False):
         """
         Push values into an array field in a document.
@@ -140,8 +303,10 @@ class Collection:
 
         update_query = {"$push": {field: {"$each": values}}}
         result = await self.collection.update_one(criteria, update_query, upsert=upsert)
+        self._write_through(criteria)
         return result
 
+    @db_timed
     async def push_many(self, criteria: dict, updates: dict, upsert: bool = False):
         """
         Push multiple values into array fields in a document.
@@ -152,8 +317,68 @@ class Collection:
         """
         push_query = {"$push": {field: {"$each": values} for field, values in updates.items()}}
         result = await self.collection.update_one(criteria, push_query, upsert=upsert)
+        self._write_through(criteria)
         return result
 
+    async def create_indexes(self) -> List[str]:
+        """
+        Create indexes declared on the model (model.indexes).
+        Idempotent, a failing index is logged and doesn't stop the others,
+        an index whose options changed (e.g. became unique) is rebuilt
+        :return: names of the indexes
+        """
+        names = []
+        for index in getattr(self.model, "indexes", []):
+            try:
+                try:
+                    names.extend(await self.collection.create_indexes([index]))
+                except OperationFailure as e:
+                    if e.code != INDEX_KEY_SPECS_CONFLICT:
+                        raise
+                    logging.warning("Rebuilding index %s on %s",
+                                    index.document["name"], self.collection.name)
+                    await self.collection.drop_index(index.document["name"])
+                    names.extend(await self.collection.create_indexes([index]))
+            except OperationFailure as e:
+                logging.error("Index %s on %s failed: %s",
+                              index.document["name"], self.collection.name, e)
+        return names
+
+    async def watch(self, on_change: Callable[[dict], Any],
+                    pipeline: Optional[list] = None,
+                    full_document: Optional[str] = None,
+                    on_status: Optional[Callable[[bool], Any]] = None):
+        """
+        Follow the collection change stream and pass every event to on_change.
+        Resumes after network errors, raises OperationFailure when the server
+        can't open a change stream (standalone mongod without replica set).
+        :param on_change: callback for a raw change event
+        :param pipeline: aggregation pipeline to filter events
+        :param full_document: "updateLookup" to receive documents on update events
+        :param on_status: called with True once the stream is open, False when it is lost
+        :return: None
+        """
+        resume_token = None
+        while True:
+            try:
+                async with self.collection.watch(pipeline,
+                                                 full_document=full_document,
+                                                 resume_after=resume_token) as stream:
+                    if on_status:
+                        on_status(True)
+                    async for change in stream:
+                        resume_token = stream.resume_token
+                        on_change(change)
+            except OperationFailure:
+                if on_status:
+                    on_status(False)
+                raise
+            except PyMongoError as e:
+                if on_status:
+                    on_status(False)
+                logging.warning("Change stream %s interrupted: %s", self.collection.name, e)
+                await asyncio.sleep(1)
+
 class MongoDbClient(BaseModel):
     """
     MongoDb models initiate
@@ -166,14 +391,24 @@ class MongoDbClient(BaseModel):
     config_admin: Any
     promo_codes: Any
     discounts: Any
+    assets: Any
+    broadcasts: Any
+    jobs: Any
+    fsm: Any
+    shared_state: Any
 
 
 db = MongoDbClient(
-    users=Collection(collection_name='users', model=User),
+    users=Collection(collection_name='users', model=User, cache=user_cache),
     category=Collection(collection_name='category', model=CategoryModel),
     transactions=Collection(collection_name='transactions', model=Transactions),
     order_history=Collection(collection_name='order_history', model=OrderHistory),
     config_admin=Collection(collection_name="config_admin", model=ConfigAdmin),
     promo_codes=Collection(collection_name="promo_codes", model=PromoCodes),
     discounts=Collection(collection_name="discounts", model=Discounts),
+    assets=Collection(collection_name="assets", model=Asset),
+    broadcasts=Collection(collection_name="broadcasts", model=Broadcast),
+    jobs=Collection(collection_name="jobs", model=Job),
+    fsm=Collection(collection_name="fsm", model=FsmRecord),
+    shared_state=Collection(collection_name="shared_state", model=SharedStateRecord),
 )
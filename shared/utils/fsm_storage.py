@@ -0,0 +1,131 @@
+"""FSM storage on MongoDB.
+    States live in the fsm collection, so they survive restarts and are
+    shared by bot replicas. Records expire by the updated_at TTL index.
+    The optional read cache (cache_ttl > 0) is for a single bot replica only:
+    another replica's writes don't reach it"""
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import (BaseStorage, DefaultKeyBuilder, KeyBuilder,
+                                     StateType, StorageKey)
+from cachetools import TTLCache
+from pymongo import ReturnDocument
+
+from shared.utils.db import Collection
+
+
+class MongoStateStorage(BaseStorage):
+    """
+    aiogram BaseStorage on the motor client
+    """
+
+    def __init__(self, collection: Collection, key_builder: Optional[KeyBuilder] = None,
+                 cache_ttl: float = 0.0, cache_size: int = 10_000):
+        self.collection = collection.collection
+        self.key_builder = key_builder or DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self.cache: Optional[TTLCache] = None
+        if cache_ttl > 0:
+            self.cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+
+    async def _record(self, key: StorageKey) -> dict:
+        """
+        State and data of the key
+        :param key:
+        :return: {"state": ..., "data": ...}
+        """
+        document_id = self.key_builder.build(key)
+        record = self.cache.get(document_id) if self.cache is not None else None
+        if record is None:
+            document = await self.collection.find_one({"_id": document_id},
+                                                      {"state": 1, "data": 1}) or {}
+            record = {"state": document.get("state"), "data": document.get("data") or {}}
+            if self.cache is not None:
+                self.cache[document_id] = record
+        return record
+
+    async def _update(self, key: StorageKey, fields: dict):
+        """
+        Write fields of the record, an empty record is deleted
+        :param key:
+        :param fields: state and/or data
+        :return: None
+        """
+        document_id = self.key_builder.build(key)
+        if not any(fields.values()):
+            await self._clear(document_id, list(fields))
+            return
+        document = await self.collection.find_one_and_update(
+            {"_id": document_id},
+            {"$set": {**fields, "updated_at": datetime.now(tz=timezone.utc)}},
+            projection={"state": 1, "data": 1},
+            upsert=True,
+            return_document=ReturnDocument.AFTER)
+        if self.cache is not None:
+            self.cache[document_id] = {"state": document.get("state"),
+                                       "data": document.get("data") or {}}
+
+    async def _clear(self, document_id: str, fields: list):
+        """
+        Unset fields without creating a record: an absent record costs one
+        update that matches nothing, a record left empty is deleted
+        :param document_id:
+        :param fields: state and/or data
+        :return: None
+        """
+        cached = self.cache.get(document_id) if self.cache is not None else None
+        if cached is not None and cached["state"] is None and not cached["data"]:
+            return
+        result = await self.collection.update_one(
+            {"_id": document_id},
+            {"$unset": {field: "" for field in fields},
+             "$set": {"updated_at": datetime.now(tz=timezone.utc)}})
+        if result.matched_count:
+            # conditional: a concurrent write of another replica survives
+            await self.collection.delete_one({"_id": document_id,
+                                              "state": None,
+                                              "data": {"$in": [None, {}]}})
+        if self.cache is not None:
+            self.cache.pop(document_id, None)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        """
+        Set state
+        :param key:
+        :param state: State, its name or None
+        :return: None
+        """
+        await self._update(key, {"state": state.state if isinstance(state, State) else state})
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        """
+        Get state
+        :param key:
+        :return: state name or None
+        """
+        return (await self._record(key))["state"]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        """
+        Replace data
+        :param key:
+        :param data:
+        :return: None
+        """
+        await self._update(key, {"data": dict(data)})
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        """
+        Get data
+        :param key:
+        :return: copy of the data
+        """
+        return dict((await self._record(key))["data"])
+
+    async def close(self) -> None:
+        """
+        The motor client is shared with db, only the cache is dropped
+        :return: None
+        """
+        if self.cache is not None:
+            self.cache.clear()
@@ -1,46 +1,28 @@
 """
 Functions
 """
+import asyncio
+import logging
 import random
 import time
 import uuid
-from datetime import datetime, timedelta, timezone
-from typing import List, Union
-from dateutil.relativedelta import relativedelta
+from contextlib import suppress
+from typing import Awaitable, Callable, List, Union
 from aiogram.exceptions import TelegramBadRequest
-from aiogram.types import (InlineKeyboardButton, InlineKeyboardMarkup, \
-                           InputMediaVideo, InputMediaDocument, InputMediaAudio,
-                           InputMediaPhoto, CallbackQuery, Message)
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery, Message
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 from shared.utils.callbacks import Knowledge, Cabinet, \
     Mailing, Category, CategoryCreate, Start, \
     CategoryRename, CategoryDelete, CategoryContent, CategoryClean, Info, Contacts
+from shared.utils.category_tree import category_tree
 from shared.utils.config import settings
 from shared.utils.db import db
+from shared.utils.keyboard_cache import keyboard_cache, locale_language
+from shared.utils.render_plan import plan_sends
+from shared.utils.subscription import deactivation, stored_end
 
-
-def calculate_subscription_info(subscribed_date: float, subscribed_period: int):
-    """
-    Info about the subscription.
-    :param subscribed_date: The timestamp when the subscription started
-    :param subscribed_period: Subscription period in months
-    :return: (remaining_days, end_time_msk) - remaining days and formatted end time
-    """
-    moscow_tz = timezone(timedelta(hours=3))
-    utc_now = datetime.now(tz=timezone.utc)
-
-    subscribe_datetime = datetime.fromtimestamp(subscribed_date, tz=timezone.utc)
-
-    end_datetime_utc = subscribe_datetime + relativedelta(months=subscribed_period)
-
-    end_datetime_msk = end_datetime_utc.astimezone(moscow_tz)
-
-    remaining_days = max((end_datetime_utc - utc_now).days, 0)
-
-    end_time_msk = end_datetime_msk.strftime('%Y-%m-%d %H:%M:%S')
-
-    return remaining_days, end_time_msk
+logger = logging.getLogger(__name__)
 
 
 async def category_buttons(category,
@@ -111,7 +93,7 @@ async def category_buttons(category,
 
 
     else:
-        res = await db.category.find_one({"id": parent_category})
+        res = category_tree.get(parent_category)
         parent_id = res.parent_id if res else None
         keyboard_category.row(
             InlineKeyboardButton(
@@ -135,7 +117,8 @@ async def generate_unique_category_id() -> str:
     """
     while True:
         category_id = str(uuid.uuid4())[:5]
-        existing_category = await db.category.find_one({'id': category_id})
+        existing_category = await db.category.find_one({'id': category_id},
+                                                       projection={'_id': 1}, raw=True)
         if not existing_category:
             return category_id
 
@@ -149,11 +132,22 @@ async def generate_unique_order_id() -> int:
     """
     while True:
         order_id = random.randint(1, 2147483647)
-        existing_transaction = await db.transactions.find_one({"order_id": order_id})
+        existing_transaction = await db.transactions.find_one({"order_id": order_id},
+                                                              projection={"_id": 1}, raw=True)
         if not existing_transaction:
             return order_id
 
 
+def user_role(user_id: int, admin_ids: List[int]) -> str:
+    """
+    Role of the user for cached keyboards.
+    :param user_id:
+    :param admin_ids:
+    :return: "admin" or "user"
+    """
+    return "admin" if user_id in admin_ids else "user"
+
+
 def build_menu_keyboard(locale, user_id: int, admin_ids: List[int]) -> InlineKeyboardMarkup:
     """
     Creates a menu keyboard depending on the user's role.
@@ -163,6 +157,12 @@ def build_menu_keyboard(locale, user_id: int, admin_ids: List[int]) -> InlineKey
     :param admin_ids: A list of administrator IDs.
     :return: An InlineKeyboardMarkup object with the keyboard layout.
     """
+    role = user_role(user_id, admin_ids)
+    language = locale_language(locale)
+    cached = keyboard_cache.get("Menu", role, language)
+    if cached is not None:
+        return cached
+
     keyboard_menu = InlineKeyboardBuilder()
 
     # Add general menu buttons
@@ -186,7 +186,7 @@ def build_menu_keyboard(locale, user_id: int, admin_ids: List[int]) -> InlineKey
                 text=locale.menubutton_admin(),
                 callback_data=Mailing().pack()))
 
-    return keyboard_menu.as_markup()
+    return keyboard_cache.put("Menu", role, language, keyboard_menu.as_markup())
 
 
 async def check_subscription(user_id):
@@ -195,12 +195,14 @@ async def check_subscription(user_id):
     :param user_id:
     :return:
     """
-    user = await db.users.find_one({"id": user_id})
+    user = await db.users.find_one({"id": user_id},
+                                   projection={"subscribed": 1,
+                                               "subscribed_date": 1,
+                                               "subscribed_period": 1,
+                                               "subscription_end": 1})
     if user.subscribed:
-        if user.subscribed_date < time.time() - user.subscribed_period * 30.44 * 24 * 60 * 60:
-            await db.users.update_one({"id": user_id}, {"subscribed": False,
-                                                        "subscribed_period": None,
-                                                        "subscribed_date": None})
+        if stored_end(user) <= time.time():
+            await db.users.update_one({"id": user_id}, deactivation())
             return False
         return True
 
@@ -223,104 +225,63 @@ async def subscription_offer(bot, user_id, locale, message_id):
                                    reply_markup=keyboard.as_markup())
 
 
-async def send_category_content(bot, message: Union[Message, CallbackQuery],
+async def send_concurrently(sends: List[Callable[[], Awaitable]], limit: int) -> List[int]:
+    """
+    Run sends concurrently, at most `limit` in flight.
+    A failed send is logged and doesn't stop the others
+    :param sends: callables from plan_sends
+    :param limit: concurrency cap for the chat
+    :return: message_ids of the sent messages
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def send(call):
+        async with semaphore:
+            return await call()
 
-                                current_id: str, locale):  # pylint: disable=all
-    # I have no time for optimize this func my deadlines in fire
+    message_ids = []
+    results = await asyncio.gather(*(send(call) for call in sends), return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logger.warning("Category media not sent: %s", result)
+        elif isinstance(result, BaseException):
+            raise result
+        elif isinstance(result, list):
+            message_ids.extend(msg.message_id for msg in result)
+        elif isinstance(result, Message):
+            message_ids.append(result.message_id)
+    return message_ids
+
+
+async def send_category_content(bot, message: Union[Message, CallbackQuery],
+                                current_id: str, locale):
     """
-    Отправляет контент категории
+    Отправляет контент категории.
+    Медиа отправляются по готовому плану (category_tree.render_plan)
+    параллельно (не больше MEDIA_SEND_CONCURRENCY одновременно),
+    подпись с клавиатурой - после всех медиа
     :param bot: объект бота
     :param message: сообщение или callback
     :param current_id: ID текущей категории
     :param locale: объект локализации
     """
-    category = await db.category.find_one({"id": current_id})
-    category_next = await db.category.find({"parent_id": current_id})
-    keyboard = await category_buttons(category_next, message.from_user.id,
-                                      locale, current_id,
-                                      category.parent_id if category else None)
-    message_ids = []
+    category = category_tree.get(current_id)
+    role = user_role(message.from_user.id, settings.ADMIN_IDS)
+    language = locale_language(locale)
+    keyboard = keyboard_cache.get(current_id, role, language)
+    if keyboard is None:
+        keyboard = await category_buttons(category_tree.children_of(current_id),
+                                          message.from_user.id,
+                                          locale, current_id,
+                                          category.parent_id if category else None)
+        keyboard_cache.put(current_id, role, language, keyboard)
 
     if isinstance(message, CallbackQuery):
-        await bot.delete_message(
-            chat_id=message.from_user.id,
-            message_id=message.message.message_id
-        )
-
-    media_fields_order = ['photos', 'videos', 'documents', 'audios', 'voices', 'video_notes']
-
-    for field in media_fields_order:
-        if category and hasattr(category, field) and getattr(category, field):
-            media_list = getattr(category, field)
-            print(f"🔥 {field.upper()} DETECTED, SENDING...")
-
-            if media_list[0].type == "media_group":
-                if field == 'photos':
-                    media_group = [
-                        InputMediaPhoto(media=file_id) for file_id in media_list[0].file_id]
-                elif field == 'videos':
-                    media_group = [
-                        InputMediaVideo(media=file_id) for file_id in media_list[0].file_id]
-                elif field == 'audios':
-                    media_group = [
-                        InputMediaAudio(media=file_id) for file_id in media_list[0].file_id]
-                elif field == 'documents':
-                    media_group = [
-                        InputMediaDocument(media=file_id) for file_id in media_list[0].file_id]
-                else:
-                    continue
-
-                messages = await bot.send_media_group(
-                    chat_id=message.from_user.id,
-                    media=media_group
-                )
-                message_ids.extend([msg.message_id for msg in messages])
-
-            else:
-                res = None
-
-                if field == 'photos':
-                    res = await bot.send_photo(
-                        chat_id=message.from_user.id,
-                        photo=media_list[0].file_id[0])
-                elif field == 'videos':
-                    res = await bot.send_video(
-                        chat_id=message.from_user.id,
-                        video=media_list[0].file_id[0])
-                elif field == 'audios':
-                    res = await bot.send_audio(
-                        chat_id=message.from_user.id,
-                        audio=media_list[0].file_id[0])
-                elif field == 'documents':
-                    res = await bot.send_document(
-                        chat_id=message.from_user.id,
-                        document=media_list[0].file_id[0])
-                elif field == 'voices':
-                    print("Отправляю voice")
-                    try:
-                        res = await bot.send_voice(chat_id=message.from_user.id, voice=media_list[0].file_id[0])
-                    except TelegramBadRequest:
-                        try:
-                            await bot.send_audio(chat_id=message.from_user.id, audio=media_list[0].file_id[0])
-                        except TelegramBadRequest:
-                            res = await bot.send_message(
-                                chat_id=message.from_user.id,
-                                text="Извините, не могу прислать вам голосовое сообщение,"
-                                     " проверьте настройки конфиденциальности!")
-                        else:
-                            raise
-                elif field == "video_notes":
-                    res = await bot.send_video_note(
-                        chat_id=message.from_user.id,
-                        video_note=media_list[0].file_id[0])
-
-                if res:
-                    message_ids.append(res.message_id)
-
-    await db.users.update_one(
-        {"id": message.from_user.id},
-        {"message_ids": message_ids}
-    )
+        with suppress(TelegramBadRequest):
+            await bot.delete_message(chat_id=message.from_user.id,
+                                     message_id=message.message.message_id)
+    sends = plan_sends(bot, message.from_user.id, category_tree.render_plan(current_id))
+    message_ids = await send_concurrently(sends, settings.MEDIA_SEND_CONCURRENCY)
 
     caption = (
         category.caption
@@ -329,8 +290,14 @@ async def send_category_content(bot, message: Union[Message, CallbackQuery],
             and category.caption)
         else "No caption"
     )
-    await bot.send_message(
-        chat_id=message.from_user.id,
-        text=caption,
-        reply_markup=keyboard
+    await asyncio.gather(
+        db.users.update_one(
+            {"id": message.from_user.id},
+            {"message_ids": message_ids}
+        ),
+        bot.send_message(
+            chat_id=message.from_user.id,
+            text=caption,
+            reply_markup=keyboard
+        )
     )
@@ -0,0 +1,23 @@
+"""Translations of messages sent outside the bot handlers (worker jobs).
+    The .ftl files live in shared/i18n, so both images ship them"""
+from pathlib import Path
+
+from fluent_compiler.bundle import FluentBundle
+from fluentogram import FluentTranslator, TranslatorHub, TranslatorRunner
+
+I18N_DIR = Path(__file__).resolve().parent.parent / "i18n"
+ROOT_LOCALE = "ru"
+
+ru_bundle = FluentBundle.from_files("ru-RU", filenames=[str(I18N_DIR / "ru" / "broadcast.ftl")])
+t_hub = TranslatorHub({"ru": ("ru",)},
+                      translators=[FluentTranslator("ru", translator=ru_bundle)],
+                      root_locale=ROOT_LOCALE)
+
+
+def get_locale(locale: str = ROOT_LOCALE) -> TranslatorRunner:
+    """
+    Translator runner
+    :param locale:
+    :return: TranslatorRunner
+    """
+    return t_hub.get_translator_by_locale(locale)
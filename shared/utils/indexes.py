@@ -0,0 +1,67 @@
+"""Index bootstrap.
+    Indexes are declared on the models (Model.indexes) and created
+    on startup of the bot and the worker. index_report runs explain()
+    on the hot queries to check they don't fall back to COLLSCAN"""
+import logging
+from typing import List, Tuple
+
+from shared.utils.db import MongoDbClient
+
+logger = logging.getLogger(__name__)
+
+HOT_QUERIES = [
+    ("users", {"id": 0}),
+    ("users", {"subscription_end": {"$lte": 0}}),
+    ("category", {"id": "Knowledge"}),
+    ("category", {"parent_id": "Knowledge"}),
+    ("transactions", {"order_id": 0}),
+    ("transactions", {"next_check_at": {"$lte": 0}}),
+    ("order_history", {"order_id": 0}),
+    ("promo_codes", {"promo_code": ""}),
+    ("discounts", {"promo_code": ""}),
+]
+
+
+async def bootstrap_indexes(database: MongoDbClient):
+    """
+    Create indexes of every collection
+    :param database: db
+    :return: None
+    """
+    for name in type(database).model_fields:
+        created = await getattr(database, name).create_indexes()
+        if created:
+            logger.info("Indexes on %s: %s", name, ", ".join(created))
+
+
+def plan_stages(plan: dict) -> List[str]:
+    """
+    Flatten stages of an explain() winning plan
+    :param plan:
+    :return: stage names from the root down
+    """
+    stages = [plan["stage"]] if "stage" in plan else []
+    for key in ("queryPlan", "inputStage"):
+        if key in plan:
+            stages.extend(plan_stages(plan[key]))
+    for child in plan.get("inputStages", []):
+        stages.extend(plan_stages(child))
+    return stages
+
+
+async def index_report(database: MongoDbClient) -> List[Tuple[str, dict, List[str]]]:
+    """
+    explain() the hot queries and log whether they are index-backed
+    :param database: db
+    :return: (collection, filter, stages) for every query
+    """
+    report = []
+    for name, query in HOT_QUERIES:
+        explain = await getattr(database, name).collection.find(query).limit(1).explain()
+        stages = plan_stages(explain["queryPlanner"]["winningPlan"])
+        report.append((name, query, stages))
+        if "COLLSCAN" in stages:
+            logger.warning("%s %s is a collection scan: %s", name, list(query), stages)
+        else:
+            logger.info("%s %s uses index: %s", name, list(query), stages)
+    return report
@@ -0,0 +1,131 @@
+"""Mongo-backed job queue.
+    The bot enqueues jobs, worker processes claim them atomically
+    with find_one_and_update and hold them with a lease that a heartbeat
+    keeps extending. When a worker dies its lease expires
+    and another worker picks the job up"""
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, Optional
+
+from shared.models.job import Job
+from shared.utils.db import db
+
+logger = logging.getLogger(__name__)
+
+LEASE_SECONDS = 60
+HEARTBEAT_INTERVAL = 20
+MAX_ATTEMPTS = 5
+
+JobHandler = Callable[[Job], Awaitable[None]]
+
+
+def new_worker_id() -> str:
+    """
+    Unique id of the worker process
+    :return: host:pid:random
+    """
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+async def enqueue(job_type: str, payload: dict) -> Job:
+    """
+    Put a job into the queue
+    :param job_type: key of the worker handler
+    :param payload:
+    :return: Job
+    """
+    job = Job(id=uuid.uuid4().hex, type=job_type, payload=payload,
+              created_at=time.time(), updated_at=time.time())
+    await db.jobs.insert_one(job.model_dump())
+    return job
+
+
+async def claim(worker_id: str) -> Optional[Job]:
+    """
+    Take the oldest queued job or a running job with an expired lease
+    :param worker_id:
+    :return: Job or None
+    """
+    now = time.time()
+    return await db.jobs.find_one_and_update(
+        {"$or": [{"status": "queued"},
+                 {"status": "running", "lease_until": {"$lt": now}}]},
+        {"$set": {"status": "running",
+                  "worker_id": worker_id,
+                  "lease_until": now + LEASE_SECONDS,
+                  "updated_at": now},
+         "$inc": {"attempts": 1}},
+        return_new=True,
+        sort=[("created_at", 1)])
+
+
+async def heartbeat(job: Job, worker_id: str):
+    """
+    Extend the lease while the job runs, returns when the lease is lost
+    :param job:
+    :param worker_id:
+    :return: None
+    """
+    while True:
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+        res = await db.jobs.update_one({"id": job.id, "worker_id": worker_id, "status": "running"},
+                                       {"lease_until": time.time() + LEASE_SECONDS,
+                                        "updated_at": time.time()})
+        if res.matched_count == 0:
+            return
+
+
+async def run_job(job: Job, handler: JobHandler, worker_id: str):
+    """
+    Run the job under its lease and store the outcome
+    :param job:
+    :param handler:
+    :param worker_id:
+    :return: None
+    """
+    work = asyncio.create_task(handler(job))
+    beat = asyncio.create_task(heartbeat(job, worker_id))
+    await asyncio.wait({work, beat}, return_when=asyncio.FIRST_COMPLETED)
+    if not work.done():
+        logger.warning("Job %s lease lost, stopping", job.id)
+        work.cancel()
+        return
+    beat.cancel()
+    if work.exception() is None:
+        status, error = "done", None
+    else:
+        error = repr(work.exception())
+        status = "failed" if job.attempts >= MAX_ATTEMPTS else "queued"
+        logger.error("Job %s (%s) failed: %s", job.id, job.type, error)
+    await db.jobs.update_one({"id": job.id, "worker_id": worker_id},
+                             {"status": status, "error": error,
+                              "lease_until": 0.0, "updated_at": time.time()})
+
+
+async def process_jobs(handlers: Dict[str, JobHandler], poll_interval: float = 2.0):
+    """
+    Worker loop: claim and run jobs one by one
+    :param handlers: job type -> handler
+    :param poll_interval: seconds between claims when the queue is empty
+    :return: None
+    """
+    worker_id = new_worker_id()
+    logger.info("Job processing started (%s)...", worker_id)
+    while True:
+        job = await claim(worker_id)
+        if job is None:
+            await asyncio.sleep(poll_interval)
+            continue
+        handler = handlers.get(job.type)
+        if handler is None:
+            logger.error("No handler for job type %s", job.type)
+            await db.jobs.update_one({"id": job.id}, {"status": "failed",
+                                                      "error": "unknown job type",
+                                                      "updated_at": time.time()})
+            continue
+        logger.info("Job %s (%s) claimed, attempt %s", job.id, job.type, job.attempts)
+        await run_job(job, handler, worker_id)
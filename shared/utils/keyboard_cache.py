@@ -0,0 +1,93 @@
+"""Cache of ready inline keyboards.
+    Keyboards are keyed by (category id, role, language of the locale
+    that rendered them) and dropped by the category tree whenever a node
+    they depend on changes. Hits, misses and size are exported on /metrics"""
+from typing import Dict, Optional, Tuple
+
+from aiogram.types import InlineKeyboardMarkup
+from fluentogram import TranslatorRunner
+
+from shared.utils.metrics import registry
+
+KEYBOARD_CACHE_REQUESTS = registry.counter(
+    "keyboard_cache_requests_total",
+    "Keyboard cache lookups by result (hit/miss)")
+KEYBOARD_CACHE_SIZE = registry.gauge(
+    "keyboard_cache_size",
+    "Cached keyboards")
+
+# (role, language) -> keyboard
+Keyboards = Dict[Tuple[str, Optional[str]], InlineKeyboardMarkup]
+
+
+class KeyboardCache:
+    """
+    Finished InlineKeyboardMarkup per category node, role and locale
+    """
+
+    def __init__(self):
+        self.keyboards: Dict[Optional[str], Keyboards] = {}
+
+    def get(self, category_id: Optional[str], role: str,
+            language: Optional[str]) -> Optional[InlineKeyboardMarkup]:
+        """
+        Cached keyboard
+        :param category_id:
+        :param role: "admin" or "user"
+        :param language: language of the locale, see locale_language
+        :return: InlineKeyboardMarkup or None
+        """
+        keyboard = self.keyboards.get(category_id, {}).get((role, language))
+        KEYBOARD_CACHE_REQUESTS.inc(result="miss" if keyboard is None else "hit")
+        return keyboard
+
+    def put(self, category_id: Optional[str], role: str,
+            language: Optional[str], keyboard: InlineKeyboardMarkup) -> InlineKeyboardMarkup:
+        """
+        Store keyboard
+        :param category_id:
+        :param role:
+        :param language:
+        :param keyboard:
+        :return: the stored keyboard
+        """
+        self.keyboards.setdefault(category_id, {})[(role, language)] = keyboard
+        self._report_size()
+        return keyboard
+
+    def invalidate(self, *category_ids: Optional[str]):
+        """
+        Drop keyboards of the categories for every role and locale
+        :param category_ids:
+        :return: None
+        """
+        for category_id in category_ids:
+            self.keyboards.pop(category_id, None)
+        self._report_size()
+
+    def clear(self):
+        """
+        Drop all keyboards
+        :return: None
+        """
+        self.keyboards.clear()
+        self._report_size()
+
+    def _report_size(self):
+        """
+        Update the size gauge
+        :return: None
+        """
+        KEYBOARD_CACHE_SIZE.set(sum(len(keyboards) for keyboards in self.keyboards.values()))
+
+
+def locale_language(locale: TranslatorRunner) -> Optional[str]:
+    """
+    Language the locale renders with, the cache key of its keyboards
+    :param locale: TranslatorRunner from TranslateMiddleware
+    :return: locale code of the first translator
+    """
+    return next((translator.locale for translator in locale.translators), None)
+
+
+keyboard_cache = KeyboardCache()
@@ -0,0 +1,197 @@
+"""In-process metrics.
+    Counters, gauges and histograms with labels,
+    rendered in the Prometheus text exposition format"""
+import bisect
+from typing import Dict, List, Tuple
+
+from aiohttp import web
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+LabelsKey = Tuple[Tuple[str, str], ...]
+
+
+def labels_key(labels: dict) -> LabelsKey:
+    """
+    Hashable labels
+    :param labels:
+    :return: sorted tuple of pairs
+    """
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def escape(value) -> str:
+    """
+    Escape label value
+    :param value:
+    :return: str
+    """
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+
+def format_labels(key: LabelsKey, **extra) -> str:
+    """
+    {name="value",...} part of a sample
+    :param key:
+    :param extra: additional labels (le for buckets)
+    :return: str
+    """
+    pairs = list(key) + list(extra.items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    """
+    Monotonic counter
+    """
+    kind = "counter"
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self.values: Dict[LabelsKey, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        """
+        Increase the counter
+        :param amount:
+        :param labels:
+        :return: None
+        """
+        key = labels_key(labels)
+        self.values[key] = self.values.get(key, 0.0) + amount
+
+    def samples(self) -> List[str]:
+        """
+        Prometheus samples
+        :return: lines
+        """
+        return [f"{self.name}{format_labels(key)} {value}" for key, value in self.values.items()]
+
+
+class Gauge(Counter):
+    """
+    Value that can go up and down
+    """
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        """
+        Set the value
+        :param value:
+        :param labels:
+        :return: None
+        """
+        self.values[labels_key(labels)] = value
+
+
+class Histogram:
+    """
+    Histogram with fixed buckets
+    """
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.series: Dict[LabelsKey, dict] = {}
+
+    def observe(self, value: float, **labels):
+        """
+        Record a value
+        :param value:
+        :param labels:
+        :return: None
+        """
+        series = self.series.setdefault(labels_key(labels), {"buckets": [0] * len(self.buckets),
+                                                             "sum": 0.0,
+                                                             "count": 0})
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series["buckets"][index] += 1
+        series["sum"] += value
+        series["count"] += 1
+
+    def samples(self) -> List[str]:
+        """
+        Prometheus samples (cumulative buckets)
+        :return: lines
+        """
+        lines = []
+        for key, series in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series["buckets"]):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(key, le=bound)} {cumulative}")
+            lines.append(f"{self.name}_bucket{format_labels(key, le='+Inf')} {series['count']}")
+            lines.append(f"{self.name}_sum{format_labels(key)} {series['sum']}")
+            lines.append(f"{self.name}_count{format_labels(key)} {series['count']}")
+        return lines
+
+
+class Registry:
+    """
+    Metrics of the process
+    """
+
+    def __init__(self):
+        self.metrics: Dict[str, object] = {}
+
+    def _register(self, metric):
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, description: str) -> Counter:
+        """
+        Get or create counter
+        :param name:
+        :param description:
+        :return: Counter
+        """
+        return self._register(Counter(name, description))
+
+    def gauge(self, name: str, description: str) -> Gauge:
+        """
+        Get or create gauge
+        :param name:
+        :param description:
+        :return: Gauge
+        """
+        return self._register(Gauge(name, description))
+
+    def histogram(self, name: str, description: str,
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        """
+        Get or create histogram
+        :param name:
+        :param description:
+        :param buckets:
+        :return: Histogram
+        """
+        return self._register(Histogram(name, description, buckets))
+
+    def render(self) -> str:
+        """
+        Prometheus text format
+        :return: str
+        """
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+async def metrics_handler(_request: web.Request) -> web.Response:
+    """
+    GET /metrics
+    :param _request:
+    :return: text exposition format
+    """
+    return web.Response(text=registry.render(), content_type="text/plain")
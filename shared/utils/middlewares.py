@@ -4,19 +4,53 @@ import logging
 import time
 from typing import Any, Awaitable, Callable, Dict, Union
 from fluentogram import TranslatorHub
-from aiogram.exceptions import TelegramBadRequest
 from aiogram import BaseMiddleware
 from aiogram.types import Update, Message, CallbackQuery
-from cachetools import TTLCache
 from motor.motor_asyncio import AsyncIOMotorClient
 
 from shared.models.user import User
+from shared.utils.cleanup import delete_in_background
+from shared.utils.shared_state import shared_state
+from shared.utils.metrics import registry
+from shared.utils.tracing import trace
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+logger = logging.getLogger(__name__)
 
-caches = {
-    "default": TTLCache(maxsize=10_000, ttl=0.1)
-}
+UPDATE_SECONDS = registry.histogram("update_seconds", "Update handling time")
+UPDATE_PART_SECONDS = registry.histogram("update_part_seconds", "DB and Telegram time of an update")
+
+# updates slower than this are logged with their trace
+SLOW_UPDATE = 1.0
+
+
+class TraceMiddleware(BaseMiddleware):  # pylint: disable=too-few-public-methods
+    """
+    Per-update trace: total, DB and Telegram time.
+    Outer middleware of dp.update, so it covers every other middleware
+    """
+
+    async def __call__(
+            self,
+            handler: Callable[[Update, Dict[str, Any]], Awaitable[Any]],
+            event: Update,
+            data: Dict[str, Any]
+    ) -> Any:
+        spent = {"db": 0.0, "telegram": 0.0}
+        token = trace.set(spent)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            elapsed = time.perf_counter() - started
+            trace.reset(token)
+            event_type = event.event_type
+            UPDATE_SECONDS.observe(elapsed, event=event_type)
+            for part, seconds in spent.items():
+                UPDATE_PART_SECONDS.observe(seconds, event=event_type, part=part)
+            if elapsed >= SLOW_UPDATE:
+                logger.info("Slow update %s (%s): %.3fs, db %.3fs, telegram %.3fs",
+                            event.update_id, event_type, elapsed, spent["db"], spent["telegram"])
 
 
 class TranslateMiddleware(BaseMiddleware):  # pylint: disable=too-few-public-methods
@@ -41,7 +75,9 @@ class TranslateMiddleware(BaseMiddleware):  # pylint: disable=too-few-public-met
 
 class UserMiddleware(BaseMiddleware):  # pylint: disable=too-few-public-methods
     """
-    Automatic user insert to db
+    Automatic user insert to db.
+    The profile is loaded once per update (through the user cache)
+    and shared with other middlewares and handlers as data["user"]
     """
 
     async def __call__(
@@ -71,14 +107,15 @@ class UserMiddleware(BaseMiddleware):  # pylint: disable=too-few-public-methods
                 await data["db"].users.insert_one(user.model_dump())
             elif user.blocked_at is not None:
                 await data["db"].users.update_one(
-                    {"chat_id": event.from_user.id}, {"$set": {"blocked_at": None}}
+                    {"id": event.from_user.id}, {"blocked_at": None}
                 )
 
             if user.updated_at < time.time() - 300:
                 await data["db"].users.update_one(
-                    {"chat_id": event.from_user.id},
-                    {"$set": event.from_user.model_dump()},
+                    {"id": event.from_user.id},
+                    {**event.from_user.model_dump(), "updated_at": int(time.time())},
                 )
+                user = await data["db"].users.find_one({"id": event.from_user.id})
 
         data["user"] = user
         return await handler(event, data)
@@ -86,9 +123,14 @@ class UserMiddleware(BaseMiddleware):  # pylint: disable=too-few-public-methods
 
 class ThrottlingMiddleware(BaseMiddleware):  # pylint: disable=too-few-public-methods
     """
-    Throttling middleware
+    Throttling middleware.
+    The window is kept in the shared state backend
     """
 
+    def __init__(self, state=shared_state, rate: float = 0.1):
+        self.state = state
+        self.rate = rate
+
     async def __call__(
             self,
             handler: Callable[[Update, Dict[str, Any]], Awaitable[Any]],
@@ -98,9 +140,8 @@ class ThrottlingMiddleware(BaseMiddleware):  # pylint: disable=too-few-public-me
         if not hasattr(event, "from_user") or event.from_user is None:
             return await handler(event, data)
 
-        if event.from_user.id in caches["default"]:
+        if not await self.state.throttle(str(event.from_user.id), self.rate):
             return
-        caches["default"][event.from_user.id] = None
         return await handler(event, data)
 
 
@@ -125,12 +166,20 @@ class DataBaseMiddleware(BaseMiddleware):  # pylint: disable=too-few-public-meth
 
 class AlbumMiddleware(BaseMiddleware):  # pylint: disable=too-few-public-methods
     """
-    Album middleware
+    Album middleware.
+    Parts are collected in the shared state backend. The replica that got
+    the first part waits until no new part arrived for `quiet` seconds
+    (every part restarts the timer, but the wait never exceeds `max_wait`)
+    and then handles the whole album exactly once. Parts arriving after
+    that are dropped by the state backend
     """
-    album_data: dict = {}
 
-    def __init__(self, latency: Union[int, float] = 0.01):
-        self.latency = latency
+    def __init__(self, state=shared_state,
+                 quiet: Union[int, float] = 0.3,
+                 max_wait: Union[int, float] = 2.0):
+        self.state = state
+        self.quiet = quiet
+        self.max_wait = max_wait
 
     async def __call__(
             self,
@@ -141,24 +190,31 @@ class AlbumMiddleware(BaseMiddleware):  # pylint: disable=too-few-public-methods
         if not message.media_group_id:
             await handler(message, data)
             return
-        try:
-            self.album_data[message.media_group_id].append(message)
-        except KeyError:
-            self.album_data[message.media_group_id] = [message]
-            await asyncio.sleep(self.latency)
-
-            data['_is_last'] = True
-            data["album"] = self.album_data[message.media_group_id]
-            await handler(message, data)
+        if not await self.state.album_add(message.media_group_id, message):
+            return
 
-        if message.media_group_id and data.get("_is_last"):
-            del self.album_data[message.media_group_id]
-            del data['_is_last']
+        deadline = time.time() + self.max_wait
+        while True:
+            updated_at = await self.state.album_updated_at(message.media_group_id)
+            if updated_at is None:
+                return
+            wait = min(updated_at + self.quiet, deadline) - time.time()
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+
+        album = await self.state.album_take(message.media_group_id)
+        if not album:
+            return
+        data["album"] = [part.as_(data["bot"]) for part in album]
+        await handler(message, data)
 
 
 class MessageCleanupMiddleware(BaseMiddleware):  # pylint: disable=too-few-public-methods
     """
-    Message cleanup middleware
+    Message cleanup middleware.
+    message_ids are taken and cleared in one atomic update,
+    so two updates never delete the same messages
     """
 
     async def __call__(
@@ -170,20 +226,12 @@ class MessageCleanupMiddleware(BaseMiddleware):  # pylint: disable=too-few-publi
         bot = data['bot']
         db = data['db']
 
-        user = await db.users.find_one({"id": event.from_user.id})
-        try:
-            if user.message_ids:
-                for message_id in user.message_ids:
-                    try:
-                        await bot.delete_message(
-                            chat_id=event.from_user.id,
-                            message_id=message_id
-                        )
-                    except TelegramBadRequest:
-                        continue
-        except TelegramBadRequest:
-            await db.users.update_one(
+        user = data.get("user") or await db.users.find_one({"id": event.from_user.id})
+        if user and user.message_ids:
+            previous = await db.users.find_one_and_update(
                 {"id": event.from_user.id},
-                {"message_ids": []}
+                {"$set": {"message_ids": []}}
             )
+            if previous and previous.message_ids:
+                delete_in_background(bot, event.from_user.id, previous.message_ids)
         return await handler(event, data)
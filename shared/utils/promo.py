@@ -0,0 +1,32 @@
+"""Promo code redemption.
+    A usage is taken with one conditional find_one_and_update
+    ($inc usages -1 guarded by usages > 0), so concurrent redemptions
+    can't spend a code more times than it allows"""
+import time
+from typing import Optional
+
+from shared.utils.code_index import code_index
+from shared.utils.db import MongoDbClient
+from shared.utils.subscription import activation
+
+
+async def redeem_promo_code(db: MongoDbClient, user_id: int, code: str) -> Optional[str]:
+    """
+    Take one usage of the promo code and activate the subscription
+    :param db:
+    :param user_id:
+    :param code: text entered by the user
+    :return: "activated", "expired" or None if there is no such promo code
+    """
+    promo_code = await db.promo_codes.find_one_and_update(
+        {"promo_code": code, "usages": {"$gt": 0}},
+        {"$inc": {"usages": -1}},
+        return_new=True)
+    if promo_code:
+        await db.users.update_one({"id": user_id}, activation(time.time(), promo_code.period))
+        return "activated"
+    deleted = await db.promo_codes.delete_one({"promo_code": code, "usages": {"$not": {"$gt": 0}}})
+    if deleted.deleted_count:
+        code_index.discard_promo_code(code)
+        return "expired"
+    return None
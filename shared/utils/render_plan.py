@@ -0,0 +1,123 @@
+"""Compiled category render plan.
+    Category media is compiled into an ordered list of sends (RenderStep)
+    when the admin changes the content, stored in category.render_plan
+    and prepared once per tree node (InputMedia objects built in advance).
+    Opening a category only executes the prepared plan"""
+from functools import partial
+from typing import Awaitable, Callable, List, Tuple
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import (InputMediaAudio, InputMediaDocument, InputMediaPhoto,
+                           InputMediaVideo, Message)
+
+from shared.models.category import CategoryModel, RenderStep
+
+MEDIA_FIELDS_ORDER = ['photos', 'videos', 'documents', 'audios', 'voices', 'video_notes']
+
+# field -> (Bot method of a single file, InputMedia type of a media group)
+FIELD_SENDS = {
+    'photos': ('send_photo', 'photo'),
+    'videos': ('send_video', 'video'),
+    'documents': ('send_document', 'document'),
+    'audios': ('send_audio', 'audio'),
+    'voices': ('send_voice', None),
+    'video_notes': ('send_video_note', None),
+}
+
+INPUT_MEDIA = {
+    'photo': InputMediaPhoto,
+    'video': InputMediaVideo,
+    'document': InputMediaDocument,
+    'audio': InputMediaAudio,
+}
+
+# Bot method -> file argument
+FILE_ARGUMENTS = {
+    'send_photo': 'photo',
+    'send_video': 'video',
+    'send_document': 'document',
+    'send_audio': 'audio',
+    'send_video_note': 'video_note',
+}
+
+PreparedStep = Tuple[str, dict]
+
+
+def compile_render_plan(category: CategoryModel) -> List[RenderStep]:
+    """
+    Ordered sends of the category media
+    :param category:
+    :return: list of RenderStep
+    """
+    plan = []
+    for field in MEDIA_FIELDS_ORDER:
+        media_list = getattr(category, field)
+        if not media_list or not media_list[0].file_id:
+            continue
+        item = media_list[0]
+        method, media = FIELD_SENDS[field]
+        if item.type == "media_group":
+            if media is None:
+                continue
+            plan.append(RenderStep(method="send_media_group", media=media, file_ids=item.file_id))
+        else:
+            plan.append(RenderStep(method=method, file_ids=item.file_id[:1]))
+    return plan
+
+
+def prepare(plan: List[RenderStep]) -> List[PreparedStep]:
+    """
+    Build Bot method arguments of the plan
+    :param plan:
+    :return: (method, kwargs without chat_id) for every step
+    """
+    prepared = []
+    for step in plan:
+        if step.method == "send_media_group":
+            media_type = INPUT_MEDIA[step.media]
+            prepared.append((step.method,
+                             {"media": [media_type(media=file_id) for file_id in step.file_ids]}))
+        elif step.method == "send_voice":
+            prepared.append((step.method, {"file_id": step.file_ids[0]}))
+        else:
+            prepared.append((step.method, {FILE_ARGUMENTS[step.method]: step.file_ids[0]}))
+    return prepared
+
+
+async def send_voice(bot, chat_id: int, file_id: str) -> Message:
+    """
+    Voice with fallbacks: as audio, then a privacy settings notice
+    (voice messages can be forbidden by the user)
+    :param bot:
+    :param chat_id:
+    :param file_id:
+    :return: sent message
+    """
+    try:
+        return await bot.send_voice(chat_id=chat_id, voice=file_id)
+    except TelegramBadRequest:
+        pass
+    try:
+        return await bot.send_audio(chat_id=chat_id, audio=file_id)
+    except TelegramBadRequest:
+        return await bot.send_message(
+            chat_id=chat_id,
+            text="Извините, не могу прислать вам голосовое сообщение,"
+                 " проверьте настройки конфиденциальности!")
+
+
+def plan_sends(bot, chat_id: int, prepared: List[PreparedStep]) -> List[Callable[[], Awaitable]]:
+    """
+    Sends of the prepared plan to the chat
+    :param bot:
+    :param chat_id:
+    :param prepared: from prepare()
+    :return: callables, each sends one message or media group
+    """
+    sends = []
+    for method, kwargs in prepared:
+        if method == "send_voice":
+            sends.append(partial(send_voice, bot, chat_id, **kwargs))
+        else:
+            sends.append(partial(getattr(bot, method), chat_id=chat_id, **kwargs))
+    return sends
@@ -4,6 +4,7 @@ import json
 import re
 from dataclasses import dataclass
 import hashlib
+import hmac
 from urllib import parse
 
 
@@ -16,6 +17,23 @@ async def calculate_signature(*args) -> str:
     return hashlib.md5(':'.join(str(arg) for arg in args).encode()).hexdigest()
 
 
+async def check_result_signature(out_sum: str, inv_id, signature: str,
+                                 password_2: str, shp: dict = None) -> bool:
+    """
+    Verify SignatureValue of the ResultURL notification
+    md5(OutSum:InvId:Password2[:Shp_key=value...])
+    :param out_sum: OutSum as received
+    :param inv_id: InvId
+    :param signature: SignatureValue
+    :param password_2: merchant password #2
+    :param shp: Shp_ parameters of the notification
+    :return: bool
+    """
+    shp_parts = [f"{key}={value}" for key, value in sorted((shp or {}).items())]
+    expected = await calculate_signature(out_sum, inv_id, password_2, *shp_parts)
+    return hmac.compare_digest(expected.lower(), str(signature).lower())
+
+
 @dataclass
 class RobokassaConfig:
     """
@@ -0,0 +1,167 @@
+"""Shared state of bot middlewares.
+    ThrottlingMiddleware and AlbumMiddleware keep their state in a backend:
+    MemoryState for a single process (no network on the hot path) or
+    MongoState, so updates of one user may land on any bot replica.
+    STATE_BACKEND setting selects the backend.
+    A taken album is remembered for TAKEN_TTL, its late parts are dropped
+    instead of starting a new album"""
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+from aiogram.types import Message
+from cachetools import TTLCache
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from shared.utils.config import settings
+from shared.utils.db import db, Collection
+
+# leftovers of crashed replicas are removed by the TTL index after this
+RECORD_TTL = 60
+
+# how long parts of a taken album are dropped
+TAKEN_TTL = 60
+
+
+class MemoryState:
+    """
+    Process-local state
+    """
+
+    def __init__(self):
+        self.throttles: Dict[float, TTLCache] = {}
+        self.albums: Dict[str, dict] = {}
+        self.taken = TTLCache(maxsize=10_000, ttl=TAKEN_TTL)
+
+    async def throttle(self, key: str, ttl: float) -> bool:
+        """
+        Open a throttling window for the key
+        :param key:
+        :param ttl: window length
+        :return: True if the event passes, False if it is throttled
+        """
+        cache = self.throttles.setdefault(ttl, TTLCache(maxsize=10_000, ttl=ttl))
+        if key in cache:
+            return False
+        cache[key] = None
+        return True
+
+    async def album_add(self, media_group_id: str, message: Message) -> bool:
+        """
+        Add album part
+        :param media_group_id:
+        :param message:
+        :return: True for the first part of the album, False for other and late parts
+        """
+        if media_group_id in self.taken:
+            return False
+        album = self.albums.setdefault(media_group_id, {"parts": [], "updated_at": 0.0})
+        album["parts"].append(message)
+        album["updated_at"] = time.time()
+        return len(album["parts"]) == 1
+
+    async def album_updated_at(self, media_group_id: str) -> Optional[float]:
+        """
+        Arrival time of the last part
+        :param media_group_id:
+        :return: timestamp or None if there is no such album
+        """
+        album = self.albums.get(media_group_id)
+        return album["updated_at"] if album else None
+
+    async def album_take(self, media_group_id: str) -> List[Message]:
+        """
+        Remove the album and return its parts
+        :param media_group_id:
+        :return: messages in message_id order
+        """
+        album = self.albums.pop(media_group_id, None)
+        self.taken[media_group_id] = True
+        if not album:
+            return []
+        return sorted(album["parts"], key=lambda part: part.message_id)
+
+
+class MongoState:
+    """
+    State in the shared_state collection, every operation is one atomic write
+    """
+
+    def __init__(self, collection: Collection):
+        self.collection = collection.collection
+
+    @staticmethod
+    def _expire_at(ttl: float = RECORD_TTL) -> datetime:
+        return datetime.now(tz=timezone.utc) + timedelta(seconds=ttl)
+
+    async def throttle(self, key: str, ttl: float) -> bool:
+        """
+        Open a throttling window for the key.
+        The upsert matches only an expired window; an open one makes
+        the insert fail on _id, so exactly one replica passes
+        :param key:
+        :param ttl: window length
+        :return: True if the event passes, False if it is throttled
+        """
+        now = time.time()
+        try:
+            await self.collection.update_one(
+                {"_id": f"throttle:{key}", "until": {"$lte": now}},
+                {"$set": {"until": now + ttl, "expire_at": self._expire_at()}},
+                upsert=True)
+        except DuplicateKeyError:
+            return False
+        return True
+
+    async def album_add(self, media_group_id: str, message: Message) -> bool:
+        """
+        Add album part
+        :param media_group_id:
+        :param message:
+        :return: True for the first part of the album, False for other and late parts
+        """
+        try:
+            record = await self.collection.find_one_and_update(
+                {"_id": f"album:{media_group_id}", "taken": {"$ne": True}},
+                {"$push": {"parts": message.model_dump(mode="json", exclude_none=True)},
+                 "$inc": {"count": 1},
+                 "$set": {"updated_at": time.time(), "expire_at": self._expire_at()}},
+                projection={"count": 1},
+                upsert=True,
+                return_document=ReturnDocument.AFTER)
+        except DuplicateKeyError:
+            # the album was taken, the upsert hit its marker
+            return False
+        return record["count"] == 1
+
+    async def album_updated_at(self, media_group_id: str) -> Optional[float]:
+        """
+        Arrival time of the last part
+        :param media_group_id:
+        :return: timestamp or None if there is no such album
+        """
+        record = await self.collection.find_one({"_id": f"album:{media_group_id}",
+                                                 "taken": {"$ne": True}},
+                                                {"updated_at": 1})
+        return record["updated_at"] if record else None
+
+    async def album_take(self, media_group_id: str) -> List[Message]:
+        """
+        Take the album parts, the record stays as a "taken" marker until TAKEN_TTL
+        :param media_group_id:
+        :return: messages in message_id order
+        """
+        record = await self.collection.find_one_and_update(
+            {"_id": f"album:{media_group_id}", "taken": {"$ne": True}},
+            {"$set": {"taken": True,
+                      "parts": [],
+                      "expire_at": self._expire_at(TAKEN_TTL)}},
+            return_document=ReturnDocument.BEFORE)
+        if not record:
+            return []
+        parts = [Message.model_validate(part) for part in record["parts"]]
+        return sorted(parts, key=lambda part: part.message_id)
+
+
+shared_state = MongoState(db.shared_state) if settings.STATE_BACKEND == "mongo" else MemoryState()
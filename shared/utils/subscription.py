@@ -0,0 +1,113 @@
+"""Subscription period.
+    The end of a subscription is computed once, on activation, and stored
+    in users.subscription_end. The cabinet, access checks and the expiry
+    worker all read the stored value"""
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Tuple
+
+from dateutil.relativedelta import relativedelta
+from pymongo import UpdateOne
+
+from shared.models.user import User
+
+logger = logging.getLogger(__name__)
+
+MOSCOW_TZ = timezone(timedelta(hours=3))
+
+# subscriptions without start date or period never expire
+NEVER = float("inf")
+
+
+def subscription_end(subscribed_date: Optional[float], subscribed_period: Optional[int]) -> float:
+    """
+    End of the subscription: start + period calendar months
+    :param subscribed_date: The timestamp when the subscription started
+    :param subscribed_period: Subscription period in months
+    :return: timestamp
+    """
+    if not subscribed_date or not subscribed_period:
+        return NEVER
+    start = datetime.fromtimestamp(subscribed_date, tz=timezone.utc)
+    return (start + relativedelta(months=subscribed_period)).timestamp()
+
+
+def activation(subscribed_date: float, subscribed_period: int) -> dict:
+    """
+    Fields of an activated subscription
+    :param subscribed_date:
+    :param subscribed_period: months
+    :return: $set document
+    """
+    return {"subscribed": True,
+            "subscribed_date": subscribed_date,
+            "subscribed_period": subscribed_period,
+            "subscription_end": subscription_end(subscribed_date, subscribed_period)}
+
+
+def deactivation() -> dict:
+    """
+    Fields of an ended subscription
+    :return: $set document
+    """
+    return {"subscribed": False,
+            "subscribed_date": None,
+            "subscribed_period": None,
+            "subscription_end": None}
+
+
+def stored_end(user: User) -> float:
+    """
+    Stored end, computed for users not migrated yet
+    :param user:
+    :return: timestamp
+    """
+    if user.subscription_end is not None:
+        return user.subscription_end
+    return subscription_end(user.subscribed_date, user.subscribed_period)
+
+
+def calculate_subscription_info(end: float) -> Tuple[int, str]:
+    """
+    Info about the subscription.
+    :param end: subscription_end
+    :return: (remaining_days, end_time_msk) - remaining days and formatted end time
+    """
+    if end == NEVER:
+        return 0, "-"
+    remaining_days = max(int((end - time.time()) // (24 * 60 * 60)), 0)
+    end_time_msk = datetime.fromtimestamp(end, tz=MOSCOW_TZ).strftime('%Y-%m-%d %H:%M:%S')
+    return remaining_days, end_time_msk
+
+
+async def migrate_subscription_end(collection, batch_size: int = 500) -> int:
+    """
+    Recompute subscription_end of every subscribed user (bulk writes).
+    Idempotent, only changed documents are written
+    :param collection: db.users
+    :param batch_size: operations per bulk_write
+    :return: number of updated users
+    """
+    updated = 0
+    operations = []
+    users = collection.iter({"subscribed": True},
+                            projection={"id": 1,
+                                        "subscribed_date": 1,
+                                        "subscribed_period": 1,
+                                        "subscription_end": 1},
+                            batch_size=batch_size,
+                            raw=True)
+    async for user in users:
+        end = subscription_end(user.get("subscribed_date"), user.get("subscribed_period"))
+        if user.get("subscription_end") == end:
+            continue
+        operations.append(UpdateOne({"id": user["id"]}, {"$set": {"subscription_end": end}}))
+        if len(operations) >= batch_size:
+            updated += (await collection.bulk_write(operations)).modified_count
+            operations = []
+    if operations:
+        updated += (await collection.bulk_write(operations)).modified_count
+    if updated:
+        logger.info("subscription_end migrated for %s users", updated)
+    return updated
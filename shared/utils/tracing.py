@@ -0,0 +1,83 @@
+"""Telegram API and MongoDB instrumentation.
+    Bot API calls are timed by a session request middleware, MongoDB calls
+    by the db_timed decorator on Collection methods. Both feed the metrics
+    registry and the trace of the current update (contextvar set by
+    TraceMiddleware), so every update knows its DB vs Telegram time"""
+import logging
+import time
+from contextvars import ContextVar
+from functools import partial, wraps
+from typing import Optional
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramAPIError, TelegramRetryAfter
+
+from shared.utils.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_SECONDS = registry.histogram("telegram_request_seconds", "Bot API call latency")
+TELEGRAM_ERRORS = registry.counter("telegram_errors_total", "Bot API errors")
+TELEGRAM_RETRY_AFTER = registry.counter("telegram_retry_after_total",
+                                        "Bot API RetryAfter responses")
+DB_SECONDS = registry.histogram("db_operation_seconds", "MongoDB operation latency")
+
+# {"db": seconds, "telegram": seconds} of the update being handled
+trace: ContextVar[Optional[dict]] = ContextVar("trace", default=None)
+
+
+def spend(part: str, seconds: float):
+    """
+    Add time to the current update trace
+    :param part: "db" or "telegram"
+    :param seconds:
+    :return: None
+    """
+    current = trace.get()
+    if current is not None:
+        current[part] += seconds
+
+
+def db_timed(func=None, *, operation: Optional[str] = None):
+    """
+    Time a Collection method, @db_timed or @db_timed(operation="...")
+    :param func: async method
+    :param operation: metric label, the method name by default
+    :return: wrapped method
+    """
+    if func is None:
+        return partial(db_timed, operation=operation)
+    operation = operation or func.__name__
+
+    @wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await func(self, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            DB_SECONDS.observe(elapsed, collection=self.collection.name, operation=operation)
+            spend("db", elapsed)
+    return wrapper
+
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):  # pylint: disable=too-few-public-methods
+    """
+    Bot session middleware: latency, errors and RetryAfter per API method
+    """
+
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter:
+            TELEGRAM_RETRY_AFTER.inc(method=name)
+            raise
+        except TelegramAPIError as e:
+            TELEGRAM_ERRORS.inc(method=name, error=type(e).__name__)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            TELEGRAM_SECONDS.observe(elapsed, method=name)
+            spend("telegram", elapsed)
@@ -0,0 +1,117 @@
+"""User profile cache.
+    UserMiddleware loads the profile once per update, middlewares and handlers
+    reuse data["user"], and writes made through db.users update the cached
+    copy, so the cache never lags behind this process' own writes.
+    Writes of other processes arrive through the users change stream, the
+    cache is enabled only while that stream is open"""
+import logging
+from typing import Any, Optional
+
+from cachetools import TTLCache
+from pymongo.errors import OperationFailure
+
+from shared.models.user import User
+from shared.utils.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class UserCache:
+    """
+    TTL-bounded id -> User cache
+    """
+
+    def __init__(self, maxsize: int = 10_000, ttl: float = 10.0):
+        self.users = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.live = False
+
+    def set_live(self, live: bool):
+        """
+        Enable the cache while the change stream is open, drop it otherwise
+        :param live:
+        :return: None
+        """
+        if not live:
+            self.users.clear()
+        self.live = live
+
+    def get(self, user_id: Any) -> Optional[User]:
+        """
+        Cached user
+        :param user_id:
+        :return: User or None
+        """
+        if not self.live:
+            return None
+        return self.users.get(user_id)
+
+    def put(self, user_id: Any, user: User):
+        """
+        Store user
+        :param user_id:
+        :param user:
+        :return: None
+        """
+        if self.live:
+            self.users[user_id] = user
+
+    def apply(self, user_id: Any, fields: dict):
+        """
+        Write-through of a $set update
+        :param user_id:
+        :param fields: updated fields
+        :return: None
+        """
+        user = self.users.get(user_id)
+        if user is None:
+            return
+        if set(fields) <= set(User.model_fields):
+            self.users[user_id] = user.model_copy(update=fields)
+        else:
+            self.evict(user_id)
+
+    def evict(self, user_id: Any):
+        """
+        Drop user
+        :param user_id:
+        :return: None
+        """
+        self.users.pop(user_id, None)
+
+    def clear(self):
+        """
+        Drop all users
+        :return: None
+        """
+        self.users.clear()
+
+    def apply_change(self, change: dict):
+        """
+        Refresh cached users changed by other processes (worker, replicas)
+        :param change: change stream event
+        :return: None
+        """
+        operation = change["operationType"]
+        document = change.get("fullDocument")
+        if operation in ("update", "replace") and document:
+            if document.get("id") in self.users:
+                document["_id"] = str(document["_id"])
+                self.users[document["id"]] = User(**document)
+        elif operation in ("delete", "drop", "dropDatabase"):
+            self.clear()
+
+    async def watch(self, collection):
+        """
+        Follow the users change stream, without it the cache stays disabled
+        :param collection: db.users
+        :return: None
+        """
+        try:
+            await collection.watch(self.apply_change,
+                                   full_document="updateLookup",
+                                   on_status=self.set_live)
+        except OperationFailure as e:
+            logger.info("Users change stream unavailable (%s), user cache disabled", e)
+
+
+user_cache = UserCache(ttl=settings.USER_CACHE_TTL)
@@ -0,0 +1,201 @@
+"""Test setup.
+    Settings are read from the environment on import, so the required
+    variables get dummy values before shared modules are imported.
+    MemoryCollection stands in for a motor collection: every operation is
+    atomic between awaits, like a single document write in MongoDB"""
+import asyncio
+import operator as op
+import os
+from types import SimpleNamespace
+
+import pytest
+from bson import ObjectId
+from pymongo import ReturnDocument
+
+TEST_ENV = {"BOT_TOKEN": "1:test",
+            "MONGO_USERNAME": "test",
+            "MONGO_PASSWORD": "test",
+            "MONGO_HOST": "localhost",
+            "MONGO_HOST_EXTERNAL": "localhost",
+            "MONGO_PORT": "27017",
+            "MONGO_PORT_EXTERNAL": "27017",
+            "MONGO_DB_NAME": "test",
+            "MONGO_DB_ROOT_NAME": "admin",
+            "ADMIN_IDS": "[1]",
+            "CACHE_CHAT_ID": "1",
+            "ROBOKASSA_LOGIN": "test",
+            "ROBOKASSA_PASSWORD_1": "test",
+            "ROBOKASSA_PASSWORD_2": "test"}
+for variable, default in TEST_ENV.items():
+    os.environ.setdefault(variable, default)
+
+# pylint: disable=wrong-import-position
+from shared.utils.db import Collection
+
+COMPARISONS = {"$gt": op.gt, "$gte": op.ge, "$lt": op.lt, "$lte": op.le}
+
+
+def _compare(value, operator: str, operand) -> bool:
+    """
+    One query operator applied to a field value (None if the field is missing)
+    :param value:
+    :param operator: $gt, $lte, ...
+    :param operand:
+    :return: bool
+    """
+    if operator == "$ne":
+        return value != operand
+    if operator == "$in":
+        return value in operand
+    if operator == "$not":
+        return not _match_value(value, operand)
+    if value is None:
+        return False
+    return COMPARISONS[operator](value, operand)
+
+
+def _match_value(value, condition) -> bool:
+    """
+    Field value against a condition: {"$op": operand, ...} or a literal
+    :param value:
+    :param condition:
+    :return: bool
+    """
+    if isinstance(condition, dict) and condition and all(key.startswith("$") for key in condition):
+        return all(_compare(value, operator, operand) for operator, operand in condition.items())
+    return value == condition
+
+
+def matches(document: dict, f: dict) -> bool:
+    """
+    MongoDB filter subset: equality, comparison operators, $not, $or
+    :param document:
+    :param f:
+    :return: bool
+    """
+    for key, condition in f.items():
+        if key == "$or":
+            if not any(matches(document, branch) for branch in condition):
+                return False
+        elif not _match_value(document.get(key), condition):
+            return False
+    return True
+
+
+class MemoryCollection:
+    """
+    In-memory motor collection
+    """
+
+    def __init__(self, name: str, documents=None):
+        self.name = name
+        self.documents = [{"_id": ObjectId(), **document} for document in documents or []]
+        self.calls = []
+
+    def _upsert(self, f: dict) -> dict:
+        """
+        New document from the equality fields of the filter
+        :param f:
+        :return: inserted document
+        """
+        document = {"_id": ObjectId(),
+                    **{key: value for key, value in f.items() if not key.startswith("$")}}
+        self.documents.append(document)
+        return document
+
+    def _first(self, f: dict):
+        """
+        First document matching the filter
+        :param f:
+        :return: dict or None
+        """
+        return next((document for document in self.documents if matches(document, f)), None)
+
+    @staticmethod
+    def _apply(document: dict, s: dict):
+        """
+        Apply $set, $unset and $inc in place
+        :param document:
+        :param s: update document
+        :return: None
+        """
+        for field, value in s.get("$set", {}).items():
+            document[field] = value
+        for field in s.get("$unset", {}):
+            document.pop(field, None)
+        for field, value in s.get("$inc", {}).items():
+            document[field] = document.get(field, 0) + value
+
+    async def find_one(self, f: dict, projection=None):  # pylint: disable=unused-argument
+        """
+        collection.find_one, projection is ignored
+        """
+        self.calls.append("find_one")
+        await asyncio.sleep(0)
+        document = self._first(f)
+        return dict(document) if document else None
+
+    async def find_one_and_update(self, f: dict, s: dict, projection=None, upsert: bool = False,
+                                  sort=None, return_document=ReturnDocument.BEFORE):
+        # pylint: disable=unused-argument,too-many-arguments,too-many-positional-arguments
+        """
+        collection.find_one_and_update, atomic, projection is ignored
+        """
+        self.calls.append("find_one_and_update")
+        await asyncio.sleep(0)
+        document = self._first(f)
+        if document is None and not upsert:
+            return None
+        before = dict(document) if document is not None else None
+        if document is None:
+            document = self._upsert(f)
+        self._apply(document, s)
+        return dict(document) if return_document == ReturnDocument.AFTER else before
+
+    async def update_one(self, f: dict, s: dict, upsert: bool = False):
+        """
+        collection.update_one
+        """
+        self.calls.append("update_one")
+        await asyncio.sleep(0)
+        document = self._first(f)
+        if document is None and upsert:
+            document = self._upsert(f)
+        if document is not None:
+            self._apply(document, s)
+        return SimpleNamespace(matched_count=int(document is not None),
+                               modified_count=int(document is not None))
+
+    async def insert_one(self, i: dict):
+        """
+        collection.insert_one
+        """
+        self.calls.append("insert_one")
+        await asyncio.sleep(0)
+        document = {"_id": ObjectId(), **i}
+        self.documents.append(document)
+        return SimpleNamespace(inserted_id=document["_id"])
+
+    async def delete_one(self, f: dict):
+        """
+        collection.delete_one
+        """
+        self.calls.append("delete_one")
+        await asyncio.sleep(0)
+        document = self._first(f)
+        if document is not None:
+            self.documents.remove(document)
+        return SimpleNamespace(deleted_count=int(document is not None))
+
+
+@pytest.fixture
+def memory_collection():
+    """
+    Factory of Collection wrappers over MemoryCollection
+    :return: make(model, name, documents) -> Collection
+    """
+    def make(model, name: str, documents=None) -> Collection:
+        collection = Collection(model=model, collection_name=name)
+        collection.collection = MemoryCollection(name, documents)
+        return collection
+    return make
@@ -0,0 +1,79 @@
+"""AlbumMiddleware replay over MemoryState"""
+import asyncio
+import random
+from datetime import datetime
+
+import pytest
+from aiogram import Bot
+from aiogram.types import Chat, Message
+
+from shared.utils.middlewares import AlbumMiddleware
+from shared.utils.shared_state import MemoryState
+
+QUIET = 0.05
+
+
+def album_part(message_id: int, media_group_id: str = "album") -> Message:
+    """
+    Part of an album
+    :param message_id:
+    :param media_group_id:
+    :return: Message
+    """
+    return Message(message_id=message_id,
+                   date=datetime.now(),
+                   chat=Chat(id=1, type="private"),
+                   media_group_id=media_group_id)
+
+
+async def replay(parts_with_delays, middleware: AlbumMiddleware) -> list:
+    """
+    Deliver every part after its delay, each as its own update
+    :param parts_with_delays: (message, delay) pairs
+    :param middleware:
+    :return: albums the handler was called with
+    """
+    dispatched = []
+    bot = Bot(token="42:TEST")
+
+    async def handler(_message: Message, data: dict):
+        dispatched.append([part.message_id for part in data["album"]])
+
+    async def deliver(message: Message, delay: float):
+        await asyncio.sleep(delay)
+        await middleware(handler, message, {"bot": bot})
+
+    await asyncio.gather(*(deliver(message, delay) for message, delay in parts_with_delays))
+    await bot.session.close()
+    return dispatched
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_shuffled_delayed_parts_dispatch_once(seed):
+    """
+    Parts arriving in any order within the quiet period make one album
+    """
+    rng = random.Random(seed)
+    message_ids = list(range(100, 110))
+    rng.shuffle(message_ids)
+    parts, arrival = [], 0.0
+    for message_id in message_ids:
+        arrival += rng.uniform(0, QUIET / 2)
+        parts.append((album_part(message_id), arrival))
+    middleware = AlbumMiddleware(state=MemoryState(), quiet=QUIET, max_wait=2.0)
+
+    dispatched = asyncio.run(replay(parts, middleware))
+
+    assert dispatched == [sorted(message_ids)]
+
+
+def test_late_part_is_dropped():
+    """
+    A part arriving after max_wait doesn't start a second album
+    """
+    middleware = AlbumMiddleware(state=MemoryState(), quiet=QUIET, max_wait=QUIET * 2)
+    parts = [(album_part(1), 0.0), (album_part(2), 0.01), (album_part(3), QUIET * 6)]
+
+    dispatched = asyncio.run(replay(parts, middleware))
+
+    assert dispatched == [[1, 2]]
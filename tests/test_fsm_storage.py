@@ -0,0 +1,40 @@
+"""MongoStateStorage writes"""
+import asyncio
+
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+
+from shared.models.fsm import FsmRecord
+from shared.utils.fsm_storage import MongoStateStorage
+
+KEY = StorageKey(bot_id=1, chat_id=1, user_id=1)
+
+
+def test_clear_absent_key_creates_nothing(memory_collection):
+    """
+    clear() of an absent key is one non-upserting update per field and no delete
+    """
+    collection = memory_collection(FsmRecord, "fsm")
+    state = FSMContext(storage=MongoStateStorage(collection), key=KEY)
+
+    asyncio.run(state.clear())
+
+    assert collection.collection.calls == ["update_one", "update_one"]
+    assert not collection.collection.documents
+
+
+def test_clear_removes_record(memory_collection):
+    """
+    clear() of a stored state deletes the record
+    """
+    collection = memory_collection(FsmRecord, "fsm")
+    state = FSMContext(storage=MongoStateStorage(collection), key=KEY)
+
+    async def scenario():
+        await state.set_state("Form:name")
+        await state.update_data(name="test")
+        await state.clear()
+        return await state.get_state(), await state.get_data()
+
+    assert asyncio.run(scenario()) == (None, {})
+    assert not collection.collection.documents
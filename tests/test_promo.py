@@ -0,0 +1,49 @@
+"""Concurrent promo code redemption"""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from shared.models.promocodes import PromoCodes
+from shared.models.user import User
+from shared.utils.promo import redeem_promo_code
+
+
+@pytest.mark.parametrize("usages, users", [(1, 10), (3, 20), (5, 5), (7, 3)])
+def test_concurrent_redemptions_respect_usages(memory_collection, usages, users):
+    """
+    N concurrent redemptions of a code with k usages activate exactly min(k, N) users
+    """
+    db = SimpleNamespace(
+        promo_codes=memory_collection(PromoCodes, "promo_codes",
+                                      [{"promo_code": "GIFT", "usages": usages, "period": 1}]),
+        users=memory_collection(User, "users",
+                                [{"id": user_id, "subscribed": False}
+                                 for user_id in range(users)]))
+
+    async def redeem_all():
+        return await asyncio.gather(*(redeem_promo_code(db, user_id, "GIFT")
+                                      for user_id in range(users)))
+
+    results = asyncio.run(redeem_all())
+
+    activations = min(usages, users)
+    assert results.count("activated") == activations
+    assert sum(user["subscribed"] for user in db.users.collection.documents) == activations
+    for promo_code in db.promo_codes.collection.documents:
+        assert promo_code["usages"] >= 0
+
+
+def test_spent_code_is_removed(memory_collection):
+    """
+    The first redemption after the last usage removes the code
+    """
+    db = SimpleNamespace(
+        promo_codes=memory_collection(PromoCodes, "promo_codes",
+                                      [{"promo_code": "GIFT", "usages": 1, "period": 1}]),
+        users=memory_collection(User, "users", [{"id": 1}, {"id": 2}]))
+
+    assert asyncio.run(redeem_promo_code(db, 1, "GIFT")) == "activated"
+    assert asyncio.run(redeem_promo_code(db, 2, "GIFT")) == "expired"
+    assert asyncio.run(redeem_promo_code(db, 2, "GIFT")) is None
+    assert not db.promo_codes.collection.documents
@@ -2,128 +2,270 @@
 import asyncio
 import logging
 import time
+from functools import partial
+from datetime import datetime, timezone
 
 from aiogram import Bot
-from aiogram.exceptions import TelegramRetryAfter, TelegramBadRequest
-from aiogram.types import InlineKeyboardButton, FSInputFile
+from aiogram.exceptions import TelegramAPIError, TelegramRetryAfter, TelegramBadRequest
+from aiogram.types import InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from aiohttp import web
+from pymongo.errors import DuplicateKeyError
 
+from shared.models.orderhistory import ORDER_HISTORY_TTL
+from shared.models.transactions import (Transactions, ACTIVATING, CLAIM_TIMEOUT,
+                                       PAYMENT_TIMEOUT, CHECK_SCHEDULE, next_check_at)
+from shared.utils.assets import asset_registry
+from shared.utils.broadcast import broadcast_job
 from shared.utils.callbacks import Start, Cabinet
-from shared.utils.check_payment import check_payment_status
+from shared.utils.check_payment import RobokassaClient
 
 from shared.utils.config import settings
 from shared.utils.db import db
+from shared.utils.indexes import bootstrap_indexes
+from shared.utils.jobs import process_jobs
+from shared.utils.metrics import metrics_handler, registry
+from shared.utils.robokassa import check_result_signature
+from shared.utils.subscription import activation, deactivation, migrate_subscription_end
+from shared.utils.tracing import TelegramMetricsMiddleware
 
 bot_token = settings.BOT_TOKEN
 bot = Bot(token=bot_token)
+bot.session.middleware(TelegramMetricsMiddleware())
 logging.basicConfig(level=logging.INFO)
 
+# longest sleep between expiry checks
+SUBSCRIPTION_CHECK_INTERVAL = 120
 
-async def check_transactions():
+TRANSACTIONS_CYCLE = registry.histogram(
+    "worker_transactions_cycle_seconds",
+    "Duration of one payment polling cycle")
+TRANSACTIONS_PENDING = registry.gauge(
+    "worker_transactions_pending",
+    "Due transactions checked in the last polling cycle")
+ROBOKASSA_RESULTS = registry.counter(
+    "worker_robokassa_results_total",
+    "ResultURL notifications by outcome")
+
+
+async def activate_order(order_id: int, current_time: float) -> str:
+    """
+    Activate subscription of a paid order.
+    The transaction is claimed (status ACTIVATING) with find_one_and_update,
+    so the webhook and the poller never work on the same order at once.
+    Every step is idempotent and the transaction is deleted only after
+    the activation, so an abandoned claim is safely retried after CLAIM_TIMEOUT
+    :param order_id: InvId
+    :param current_time:
+    :return: "activated", "in_progress" (claimed by another call)
+             or "duplicate" (no pending transaction)
     """
-    Check payment status
+    claimed_at = time.time()
+    order = await db.transactions.find_one_and_update(
+        {"order_id": order_id,
+         "$or": [{"status": {"$ne": ACTIVATING}},
+                 {"claimed_at": {"$lte": claimed_at - CLAIM_TIMEOUT}}]},
+        {"$set": {"status": ACTIVATING,
+                  "claimed_at": claimed_at,
+                  "next_check_at": claimed_at + CLAIM_TIMEOUT}})
+    if order is None:
+        pending = await db.transactions.find_one({"order_id": order_id},
+                                                 projection={"_id": 1}, raw=True)
+        return "in_progress" if pending else "duplicate"
+
+    logging.info("Payment complete : %s", order.order_id)
+    try:
+        await db.order_history.insert_one({
+            "order_id": order.order_id,
+            "created_at": current_time,
+            "expire_at": datetime.fromtimestamp(current_time + ORDER_HISTORY_TTL,
+                                                tz=timezone.utc)
+        })
+    except DuplicateKeyError:
+        logging.info("Resuming activation : %s", order.order_id)
+    await db.users.update_one({"id": order.user_id}, activation(current_time, order.period))
+    await db.transactions.delete_one({"order_id": order.order_id})
+
+    keyboard = InlineKeyboardBuilder()
+    keyboard.row(InlineKeyboardButton(text="Назад", callback_data=Start().pack()))
+    try:
+        await bot.edit_message_caption(
+            chat_id=order.user_id,
+            message_id=order.message_id,
+            caption="Ваш платеж прошел успешно!",
+            reply_markup=keyboard.as_markup()
+        )
+    except TelegramAPIError as e:
+        logging.error(f"Payment message not updated: {e} : %s", order.order_id)
+    return "activated"
+
+
+async def process_order(order: Transactions, payment_status, current_time: float):
+    """
+    Apply payment status of one order
+    :param order:
+    :param payment_status: Robokassa state code
+    :param current_time: time of the cycle start
     :return: None
     """
-    logging.info("Transactions check started...")
-    while True:
-        current_time = time.time()
-        orders_to_check = await db.transactions.find({})
-        keyboard = InlineKeyboardBuilder()
-        keyboard.row(InlineKeyboardButton(text="Назад", callback_data=Start().pack()))
-
-        for order in orders_to_check:
-            logging.info("Transactions : %s", orders_to_check)
-            payment_status = await check_payment_status(
-                settings.ROBOKASSA_LOGIN,
-                order.order_id,
-                settings.ROBOKASSA_PASSWORD_2
-            )
-
-            if payment_status == 100:
-                logging.info("Payment complete : %s", order.order_id)
-                await db.order_history.insert_one({
-                    "order_id": order.order_id,
-                    "created_at": current_time
-                })
-                await db.users.update_one(
-                    {"id": order.user_id},
-                    {
-                        "subscribed": True,
-                        "subscribed_date": current_time,
-                        "subscribed_period": order.period
-                    }
-                )
+    # a claimed order was paid, an abandoned claim is finished here
+    if payment_status == 100 or order.status == ACTIVATING:
+        await activate_order(order.order_id, current_time)
 
+    else:
+        if current_time - order.created_at > PAYMENT_TIMEOUT:
+            if not await db.transactions.find_one_and_delete({"order_id": order.order_id,
+                                                              "status": {"$ne": ACTIVATING}}):
+                return
+
+            keyboard = InlineKeyboardBuilder()
+            keyboard.row(InlineKeyboardButton(text="Назад", callback_data=Start().pack()))
+            try:
                 await bot.edit_message_caption(
                     chat_id=order.user_id,
                     message_id=order.message_id,
-                    caption="Ваш платеж прошел успешно!",
+                    caption="Извините, подписка не была оплачена.",
                     reply_markup=keyboard.as_markup()
                 )
+            except TelegramBadRequest as e:
+                logging.error(f"BadRequest: {e} : %s", order.order_id)
+            except TelegramRetryAfter as e:
+                logging.error(f"RetryAfter: {e} : %s", order.order_id)
+                await asyncio.sleep(e.retry_after)
+            logging.info("Transaction deleted (1hour timeout) : %s", order.order_id)
+            return
+        await db.transactions.update_one(
+            {"order_id": order.order_id, "status": {"$ne": ACTIVATING}},
+            {"next_check_at": next_check_at(order.created_at, current_time)}
+        )
+        logging.info("Transaction is not completed yet: %s", order.order_id)
 
-                await db.transactions.delete_one(
-                    {"order_id": order.order_id}
-                )
 
-            else:
-                if current_time - order.created_at > 3600:
-                    await db.transactions.delete_one({"order_id": order.order_id})
+async def check_transactions(robokassa: RobokassaClient):
+    """
+    Reconcile payment status.
+    Payments are confirmed by the ResultURL webhook, polling catches
+    missed notifications and expires unpaid orders.
+    Only orders whose next_check_at is due are loaded (indexed query),
+    the next check is rescheduled by the backoff in CHECK_SCHEDULE.
+    Orders are checked concurrently (PAYMENT_CHECK_CONCURRENCY at a time)
+    and processed as soon as their status arrives
+    :param robokassa: shared Robokassa client
+    :return: None
+    """
+    logging.info("Transactions check started...")
+    semaphore = asyncio.Semaphore(settings.PAYMENT_CHECK_CONCURRENCY)
+
+    async def check(order: Transactions):
+        async with semaphore:
+            return order, await robokassa.check_payment_status(order.order_id)
 
-                    try:
-                        await bot.edit_message_caption(
-                            chat_id=order.user_id,
-                            message_id=order.message_id,
-                            caption="Извините, подписка не была оплачена.",
-                            reply_markup=keyboard.as_markup()
-                        )
-                    except TelegramBadRequest as e:
-                        logging.error(f"BadRequest: {e} : %s", order.order_id)
-                    except TelegramRetryAfter as e:
-                        logging.error(f"RetryAfter: {e} : %s", order.order_id)
-                        await asyncio.sleep(e.retry_after)
-                    logging.info("Transaction deleted (1hour timeout) : %s", order.order_id)
-                logging.info("Transaction is not completed yet: %s", order.order_id)
+    while True:
+        started = time.monotonic()
+        current_time = time.time()
+        due = {"$or": [{"next_check_at": {"$lte": current_time}},
+                       {"next_check_at": None}]}
+        checks = [asyncio.create_task(check(order))
+                  async for order in db.transactions.iter(due)]
 
-        await asyncio.sleep(10)
+        for finished in asyncio.as_completed(checks):
+            order, payment_status = await finished
+            await process_order(order, payment_status, current_time)
+
+        duration = time.monotonic() - started
+        TRANSACTIONS_CYCLE.observe(duration)
+        TRANSACTIONS_PENDING.set(len(checks))
+        logging.info("Transactions cycle: %s orders in %.2fs", len(checks), duration)
+        await asyncio.sleep(CHECK_SCHEDULE[0][1])
 
 
 async def subscription_notification():
     """
-    subscription notification
+    subscription notification.
+    Only users with subscription_end <= now are loaded (indexed query),
+    then the worker sleeps until the next expiry
     :return:
     """
     logging.info("Subscription notification started...")
     while True:
-        print(f"current time: {time.time()}")
-        all_users = await db.users.find({})
-
-        for user in all_users:
-            if not user.subscribed:
-                continue
-
-            subscribed_date = user.subscribed_date
-            subscribed_period = user.subscribed_period
-
-            if not subscribed_date or not subscribed_period:
-                continue
-
-            subscription_end = subscribed_date + (subscribed_period * 30 * 24 * 60 * 60)
-            time_left = subscription_end - time.time()
-
-            if time_left <= 0:
-                keyboard = InlineKeyboardBuilder()
-                keyboard.row(InlineKeyboardButton(text="👤 Подписка", callback_data=Cabinet().pack()))
-                await bot.send_photo(chat_id=user.id,
-                                     photo=FSInputFile(
-                                         "welcome.jpg", filename="welcome.jpg"),
-                                     caption=f'ПОДПИСКА НЕ ОФОРМЛЕНА!\n'
-                                             'База знаний "Юрист Бьюти Бот" недоступна!\n'
-                                             '⚜️Для активации сервиса, пожалуйста, перейдите в раздел "Подписка" в меню ниже',
-                                     reply_markup=keyboard.as_markup())
-                await db.users.update_one({"id": user.id}, {"subscribed": False,
-                                                            "subscribed_date": None,
-                                                            "subscribed_period": None})
-        await asyncio.sleep(120)
+        current_time = time.time()
+        expired_users = db.users.iter({"subscribed": True,
+                                       "subscription_end": {"$lte": current_time}},
+                                      projection={"id": 1})
+
+        async for user in expired_users:
+            keyboard = InlineKeyboardBuilder()
+            keyboard.row(InlineKeyboardButton(text="👤 Подписка", callback_data=Cabinet().pack()))
+            try:
+                await asset_registry.send_photo(
+                    bot, user.id, "welcome.jpg",
+                    caption='ПОДПИСКА НЕ ОФОРМЛЕНА!\n'
+                            'База знаний "Юрист Бьюти Бот" недоступна!\n'
+                            '⚜️Для активации сервиса, пожалуйста, '
+                            'перейдите в раздел "Подписка" в меню ниже',
+                    reply_markup=keyboard.as_markup())
+            except TelegramAPIError as e:
+                logging.error(f"Expiry notification failed: {e} : %s", user.id)
+            await db.users.update_one({"id": user.id}, deactivation())
+
+        upcoming = await db.users.find({"subscribed": True,
+                                        "subscription_end": {"$gt": current_time}},
+                                       count=1,
+                                       projection={"subscription_end": 1},
+                                       sort=[("subscription_end", 1)])
+        delay = SUBSCRIPTION_CHECK_INTERVAL
+        if upcoming:
+            delay = min(delay, upcoming[0].subscription_end - time.time())
+        await asyncio.sleep(max(delay, 1))
+
+
+async def robokassa_result(request: web.Request) -> web.Response:
+    """
+    Robokassa ResultURL: verify the signature and activate the order
+    :param request: notification (POST form or GET query)
+    :return: OK{InvId} when accepted
+    """
+    data = await request.post() if request.method == "POST" else request.query
+    try:
+        inv_id = int(data["InvId"])
+        out_sum = data["OutSum"]
+        signature = data["SignatureValue"]
+    except (KeyError, ValueError):
+        ROBOKASSA_RESULTS.inc(outcome="invalid")
+        return web.Response(status=400, text="bad request")
+
+    shp = {key: value for key, value in data.items() if key.startswith("Shp_")}
+    if not await check_result_signature(out_sum, data["InvId"], signature,
+                                        settings.ROBOKASSA_PASSWORD_2, shp):
+        logging.warning("ResultURL: bad signature : %s", inv_id)
+        ROBOKASSA_RESULTS.inc(outcome="bad_signature")
+        return web.Response(status=403, text="bad sign")
+
+    outcome = await activate_order(inv_id, time.time())
+    ROBOKASSA_RESULTS.inc(outcome=outcome)
+    if outcome == "in_progress":
+        # not OK: Robokassa repeats the notification later
+        return web.Response(status=503, text="in progress")
+    return web.Response(text=f"OK{inv_id}")
+
+
+async def run_web_server():
+    """
+    HTTP server of the worker: ResultURL and /metrics
+    :return: None
+    """
+    app = web.Application()
+    app.router.add_route("*", "/robokassa/result", robokassa_result)
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, settings.WORKER_WEB_HOST, settings.WORKER_WEB_PORT)
+    await site.start()
+    logging.info("Web server started on %s:%s", settings.WORKER_WEB_HOST, settings.WORKER_WEB_PORT)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
 
 
 async def main():
@@ -131,11 +273,16 @@ async def main():
     Async main function
     """
     logging.info("Starting workers")
+    await bootstrap_indexes(db)
+    await migrate_subscription_end(db.users)
 
-    await asyncio.gather(
-        check_transactions(),
-        subscription_notification()
-    )
+    async with RobokassaClient(settings) as robokassa:
+        await asyncio.gather(
+            run_web_server(),
+            check_transactions(robokassa),
+            subscription_notification(),
+            process_jobs({"broadcast": partial(broadcast_job, bot)})
+        )
 
 
 if __name__ == "__main__":